@@ -1,9 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from functools import partial
+from pathlib import Path
 import subprocess as procs
+import sys
+import threading
+import time
 
 from lohup import config
+from lohup.cache import CacheManager
+from lohup.coordinator import Claim, Coordinator
+from lohup.fingerprint import StreamFingerprint
+from lohup.history import History
+from lohup.journal import Journal
 from lohup.logger import BasicLogger, LogLevel, LoggerProto
+from lohup.memory import MemoryScheduler
+from lohup.output import BackupResult, Spawner
 from lohup.restic import Restic
 from lohup.rustic import Rustic
+from lohup.tuning import ConnectionTuner
+from lohup.watch import Watcher
 
 
 class Lohup:
@@ -11,32 +27,60 @@ class Lohup:
         self._config_path = config_path or "lohup.toml"
         self.config = None
         self.subsystem = None
+        self.cache = None
         self.log = logger or BasicLogger(level=LogLevel.INFO)
+        self.spawner = Spawner(self.log)
+        self.history = None
+        self.tuner = None
+        self.coordinator = None
 
     def load(self):
         self.config = config.TomlConfig.from_file(self._config_path, logger=self.log)
         self.subsystem = self.config.settings.subsystem
         if self.subsystem not in ("restic", "rustic"):
             raise KeyError(f"Invalid subsystem: {self.subsystem}")
+        self.cache = CacheManager.from_conf(self.config.settings, log=self.log)
+        self.log.limiter.interval = self.config.settings.progress_interval
+        self.spawner = Spawner(self.log, tail=self.config.settings.output_tail)
+        self.history = History.load(self.config.settings.state_dir / "history.json")
+        self.tuner = ConnectionTuner(self.history, log=self.log)
+        self.coordinator = Coordinator(
+            self.config.settings.build_dir / "locks", log=self.log
+        )
 
     def invoke_direct(self, repo: str, args: tuple[str, ...]):
-        spec = self.config.repos.get(repo) if repo else self._default_repo
-        if spec is None:
-            raise KeyError(f"Unknown repo: {repo}")
-        engine = self._engine_for(spec)
+        engine = self._engine_for(self._repo_named(repo))
         with engine:
             engine.run(args)
 
-    def _exechooks(self, hooks: list):
-        for h in hooks:
+    def _exechooks(self, hooks: list, journal: Journal | None = None):
+        for index, h in enumerate(hooks):
+            if journal is not None and journal.is_hook_done("before-all", index):
+                if self._is_reusable(h):
+                    self.log.info(f"Reusing state of {h.hook_kind} hook #{index}")
+                    continue
             match h:
                 case config.BtrfsHook():
                     self._btrfs(h)
                 case config.CommandHook():
-                    procs.check_call(h.command.split())
+                    self.spawner.check_call(
+                        h.command.split(), source=f"hook {h.hook_kind}"
+                    )
+            if journal is not None:
+                journal.hook_done("before-all", index)
 
     @staticmethod
-    def _btrfs(spec: config.BtrfsHook):
+    def _is_reusable(hook: config.Hook):
+        """
+        Whether hook done by interrupted run still has its effect.
+        Only btrfs snapshots can be checked, commands are executed again.
+        """
+        match hook:
+            case config.BtrfsHook(action="snapshot", snapshot=str(path)):
+                return Path(path).exists()
+        return False
+
+    def _btrfs(self, spec: config.BtrfsHook):
         cmd = ["btrfs"]
         if spec.action == "snapshot":
             cmd += ["subvolume", "snapshot", spec.subvolume, spec.snapshot]
@@ -44,71 +88,455 @@ class Lohup:
             cmd += ["subvolume", "delete", spec.subvolume]
         else:
             raise ValueError(f"Unknown btrfs action: {spec.action}")
-        procs.check_call(cmd)
+        self.spawner.check_call(cmd, source=f"hook {spec.hook_kind}")
 
     @property
     def _default_repo(self):
-        default_list = list(filter(lambda x: x.default, self.config.repos.values()))
-        return default_list.pop() if default_list else None
+        return self.config.default_repo
+
+    def _repo_named(self, name: str | None):
+        spec = self.config.repos.get(name) if name else self._default_repo
+        if spec is None:
+            raise KeyError(f"Unknown repo: {name}")
+        return spec
 
     def _repo_for(self, profile: config.Profile):
-        default = self._default_repo
-        if profile.repo is not None:
-            if repo := self.config.repos.get(profile.repo):
-                return repo
-            else:
-                raise KeyError(f"No repo attached to profile: {profile.name!r}")
-        if default is None:
+        repo = self.config.profile_repos.get(profile.name)
+        if repo is None:
             raise KeyError(f"No repo attached to profile: {profile.name!r}")
-        return default
+        return repo
 
-    def _engine_for(self, repo: config.Repository):
+    def _engine_for(
+        self, repo: config.Repository, profile: config.Profile | None = None
+    ):
+        settings = self.config.settings
+        cache_dir = self.cache.dir_for(repo) if self.cache else None
+        connections = None
+        if self._is_tuned(repo):
+            connections = self.tuner.current(repo.name)
+        memory = profile.memory if profile is not None else None
         match self.subsystem:
             case "rustic":
                 return Rustic(
-                    repo, log=self.log, conf_dir=self.config.settings.build_dir
+                    repo,
+                    log=self.log,
+                    conf_dir=settings.build_dir,
+                    cache_dir=cache_dir,
+                    spawner=self.spawner,
+                    connections=connections,
+                    memory_limit=memory,
+                    memory_cgroup=settings.memory_cgroup,
                 )
             case "restic":
-                return Restic(repo, log=self.log)
+                return Restic(
+                    repo,
+                    log=self.log,
+                    cache_dir=cache_dir,
+                    spawner=self.spawner,
+                    connections=connections,
+                    memory_limit=memory,
+                    memory_cgroup=settings.memory_cgroup,
+                    gogc=settings.gogc,
+                )
             case x:
                 raise KeyError(f"Unknown subsystem: {x}")
 
     def backup(self, profile: str):
-        spec = self._profile_for(profile)
-        repo = self._repo_for(spec)
-        engine = self._engine_for(repo)
-        self._exechooks(self.config.hooks.before_all)
-        try:
-            self._invoke_profile(engine, profile=spec)
-        finally:
-            self._exechooks(self.config.hooks.after_all)
+        self._backup_many([self._profile_for(profile)])
+
+    def backup_all(self, resume=False):
+        """
+        Backs up every profile. Progress is journaled in the build dir,
+        with `resume` profiles completed by the interrupted run are skipped
+        and the btrfs snapshot it created is reused.
+        """
+        profiles = list(self.config.profiles.values())
+        self._backup_many(profiles, journaled=True, resume=resume)
+        self._replicate({self._repo_for(x).name for x in profiles})
+
+    def _open_journal(self, resume: bool) -> Journal:
+        path = self.config.settings.build_dir / "backup-all.journal.json"
+        journal = Journal.load(path) if resume else None
+        if journal is not None:
+            self.log.info(f"Resuming backup-all run started at {journal.started}")
+            return journal
+        if resume:
+            self.log.info("No interrupted run found, starting from scratch")
+        elif path.exists():
+            self.log.warning(
+                "Previous backup-all run was interrupted, use --resume to continue it"
+            )
+        journal = Journal(path)
+        journal.save()
+        return journal
+
+    def sync(
+        self, source: str, target: str, tags: tuple[str, ...] = (), jobs: int = 4
+    ):
+        """
+        Copies snapshots missing in `target` repository from `source` one.
+        Snapshots are compared by ID and by ID of the original snapshot
+        engines record when copying, copies run in parallel per profile tag.
+        """
+        src_spec, dst_spec = self._repo_named(source), self._repo_named(target)
+        if src_spec is dst_spec:
+            raise ValueError("Source and target repositories are the same")
+        src_engine, dst_engine = self._engine_for(src_spec), self._engine_for(dst_spec)
+        with src_engine, dst_engine, ThreadPoolExecutor(max_workers=jobs) as pool:
+            src_list = pool.submit(src_engine.snapshots, format="json", tags=tags)
+            dst_list = pool.submit(dst_engine.snapshots, format="json", tags=tags)
+            present = set()
+            for snap in dst_list.result():
+                present.add(snap.id)
+                if snap.original:
+                    present.add(snap.original)
+            groups: dict[str, list[str]] = {}
+            for snap in src_list.result():
+                if snap.id not in present:
+                    groups.setdefault(",".join(snap.tags), []).append(snap.id)
+            if not groups:
+                self.log.info(f"Repo {target!r} is up to date with {source!r}")
+                return
+            futures = []
+            for tag, ids in groups.items():
+                self.log.info(f"Copying {len(ids)} snapshots of {tag or 'untagged'}")
+                label = f"sync {tag or source}"
+                futures.append(
+                    pool.submit(dst_engine.copy_from, src_engine, ids, source=label)
+                )
+            for future in futures:
+                future.result()
+        self.log.info(f"Replicated {source!r} to {target!r}")
+
+    def _replicate(self, repos: set[str]):
+        for name in repos:
+            spec = self.config.repos[name]
+            if spec.replicate_to is None:
+                continue
+            if not spec.replicate_background:
+                self.sync(name, spec.replicate_to)
+                continue
+            if getattr(sys, "frozen", False):
+                cmd = [sys.executable]
+            else:
+                cmd = [sys.executable, "-m", "lohup.cli"]
+            cmd += ["--config", str(Path(self._config_path).absolute())]
+            cmd += ["sync", "--from", name, "--to", spec.replicate_to]
+            build_dir = self.config.settings.build_dir
+            build_dir.mkdir(parents=True, exist_ok=True)
+            logfile = build_dir / f"sync-{name}-{spec.replicate_to}.log"
+            self.log.info(
+                f"Replicating {name!r} to {spec.replicate_to!r} in background, "
+                f"log: {logfile}"
+            )
+            with logfile.open("ab") as out:
+                procs.Popen(
+                    cmd,
+                    stdin=procs.DEVNULL,
+                    stdout=out,
+                    stderr=procs.STDOUT,
+                    start_new_session=True,
+                )
+
+    def watch(self, names: tuple[str, ...] = ()):
+        """
+        Backs up paths profiles continuously, when their paths change.
+        Watches profiles with watch settings, or the `names` given.
+        """
+        if names:
+            profiles = [self._profile_for(x) for x in names]
+        else:
+            profiles = [
+                x
+                for x in self.config.profiles.values()
+                if isinstance(x, config.PathsProfile) and x.watch
+            ]
+        for spec in profiles:
+            if not isinstance(spec, config.PathsProfile) or spec.watch is None:
+                raise KeyError(f"Profile {spec.name!r} has no watch settings")
+        if not profiles:
+            raise KeyError("No profiles with watch settings")
+        watched = [self._watched(x) for x in profiles]
+        Watcher(watched, backup=self.backup, log=self.log).run()
+
+    def _watched(self, profile: config.PathsProfile) -> config.PathsProfile:
+        """
+        Returns copy of the profile with live paths to watch. Paths inside
+        a btrfs snapshot made by before-all hooks are mapped back to the
+        snapshotted subvolume, unless watch paths are set explicitly.
+        """
+        if profile.watch.paths:
+            return replace(profile, paths=profile.watch.paths)
+        snapshots = [
+            (Path(x.snapshot), Path(x.subvolume))
+            for x in self.config.hooks.before_all
+            if isinstance(x, config.BtrfsHook) and x.action == "snapshot"
+        ]
+
+        def live(path: str) -> str:
+            for snapshot, subvolume in snapshots:
+                if Path(path).is_relative_to(snapshot):
+                    return str(subvolume / Path(path).relative_to(snapshot))
+            return path
+
+        return replace(
+            profile,
+            paths=[live(x) for x in profile.paths],
+            exclude_paths=[live(x) for x in profile.exclude_paths],
+        )
+
+    def backup_selected(
+        self,
+        names: tuple[str, ...] = (),
+        match: tuple[str, ...] = (),
+        tags: tuple[str, ...] = (),
+        repo: str | None = None,
+    ):
+        """
+        Backs up profiles selected by exact names, glob patterns and tags,
+        optionally limited to ones stored in repository `repo`.
+        """
+        for name in names:
+            self._profile_for(name)
+        selected = self.config.select(patterns=names + match, tags=tags, repo=repo)
+        if not selected:
+            raise KeyError("No profiles matched the selection")
+        self._backup_many(selected)
+
+    def _backup_many(
+        self, profiles: list[config.Profile], journaled=False, resume=False
+    ):
+        """
+        Backs up `profiles` once this run holds their locks. With `journaled`
+        progress is kept in the backup-all journal, which is opened only
+        under the run lock, so concurrent runs never share it.
+        """
+        names = [x.name for x in profiles]
+        with self.coordinator.claim(names, exclusive=journaled) as claim:
+            # state saved by runs finished while this one was waiting
+            self.history.reload()
+            journal = self._open_journal(resume) if journaled else None
+            if journal is not None:
+                for name, snapshot_id in journal.completed.items():
+                    self.log.info(
+                        f"Skipping {name!r}: done by previous run ({snapshot_id})"
+                    )
+                profiles = [x for x in profiles if x.name not in journal.completed]
+            for name, snapshot_id in claim.coalesced.items():
+                self.log.info(f"Profile {name!r} done by another run ({snapshot_id})")
+                if journal is not None:
+                    journal.profile_done(name, snapshot_id)
+            profiles = [x for x in profiles if x.name in claim.names]
+            if profiles:
+                self._run_claimed(profiles, claim, journal=journal)
+            if journal is not None:
+                journal.finish()
         self.log.info("Finished!")
 
-    def backup_all(self):
+    def _run_claimed(
+        self, profiles: list[config.Profile], claim: Claim, journal: Journal | None
+    ):
+        if self.cache:
+            keep = {self._repo_for(x).name for x in profiles}
+            self.cache.enforce(keep=keep)
         engines = {}
-        for name, spec in self.config.profiles.items():
-            engine = self._engine_for(self._repo_for(spec))
-            engines[name] = engine
-        self._exechooks(self.config.hooks.before_all)
+        for spec in profiles:
+            engines[spec.name] = self._engine_for(self._repo_for(spec), profile=spec)
+        self._exechooks(self.config.hooks.before_all, journal=journal)
         try:
-            for name, spec in self.config.profiles.items():
-                self._invoke_profile(engines[name], profile=spec)
+            self._run_parallel(profiles, engines, claim, journal)
         finally:
             self._exechooks(self.config.hooks.after_all)
-        self.log.info("Finished!")
+            if journal is not None:
+                journal.reset_hooks("before-all")
 
-    def snapshots(self, repo: str, is_json=False):
-        spec = self.config.repos.get(repo) if repo else self._default_repo
-        if spec is None:
-            raise KeyError(f"Unknown repo: {repo}")
-        restic = Restic(spec, log=self.log)
+    def _run_parallel(
+        self,
+        profiles: list[config.Profile],
+        engines: dict,
+        claim: Claim,
+        journal: Journal | None,
+    ):
+        """
+        Runs up to `jobs` backups at once, as long as their memory estimates
+        fit. No new backups are started after the first failure.
+        """
+        scheduler = MemoryScheduler.from_conf(self.config.settings, log=self.log)
+        failed = threading.Event()
+        results: dict[str, BackupResult] = {}
+
+        def run(spec: config.Profile):
+            if failed.is_set():
+                return
+            with scheduler.reserve(spec.name, self._memory_estimate(spec)):
+                if failed.is_set():
+                    return
+                try:
+                    result = self._invoke_profile(engines[spec.name], profile=spec)
+                except BaseException:
+                    failed.set()
+                    raise
+            if result.peak_rss:
+                self.history.update_profile(spec.name, peak_rss=result.peak_rss)
+            results[spec.name] = result
+            claim.record(spec.name, result.snapshot_id)
+            if journal is not None:
+                journal.profile_done(spec.name, result.snapshot_id)
+
+        jobs = self.config.settings.jobs
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(run, spec) for spec in profiles]
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            self._tune(profiles, engines, results)
+            self.history.save()
+
+    def _tune(self, profiles: list[config.Profile], engines: dict, results: dict):
+        """
+        Records throughput of the run once per repository, all engines
+        of a repository were started with the same connection count.
+        """
+        tuned: dict[str, tuple] = {}
+        for spec in profiles:
+            engine = engines[spec.name]
+            if not self._is_tuned(engine.repo):
+                continue
+            _, done = tuned.setdefault(engine.repo.name, (engine.connections, []))
+            if spec.name in results:
+                done.append(results[spec.name])
+        for name, (connections, done) in tuned.items():
+            self.tuner.record(name, connections, done)
+
+    def _memory_estimate(self, profile: config.Profile) -> int:
+        """
+        Peak RSS of the previous backup, or configured budget if unknown.
+        """
+        peak = self.history.profile(profile.name).get("peak_rss")
+        return peak or profile.memory or 0
+
+    def snapshots(
+        self,
+        repo: str,
+        is_json=False,
+        tags: tuple[str, ...] = (),
+        host: str | None = None,
+        latest: int | None = None,
+    ):
+        """
+        Returns snapshot.Snapshot list with `is_json`, or engine text output.
+        """
         format = "json" if is_json else "text"
-        return restic.snapshots(format=format)
+        with self._engine_for(self._repo_named(repo)) as engine:
+            return engine.snapshots(format=format, tags=tags, host=host, latest=latest)
+
+    def snapshots_all(
+        self,
+        is_json=False,
+        tags: tuple[str, ...] = (),
+        host: str | None = None,
+        latest: int | None = None,
+    ):
+        """
+        Queries every repository concurrently.
+        With `is_json` returns snapshots of all repositories sorted by time,
+        each with the repo name set, otherwise returns {repo: text output}.
+        Failed repositories are logged and skipped, their names are
+        returned along with the result.
+        """
+        query = partial(
+            self.snapshots, is_json=is_json, tags=tags, host=host, latest=latest
+        )
+        results = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(self.config.repos)) as pool:
+            futures = {name: pool.submit(query, name) for name in self.config.repos}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    self.log.error(f"repo {name!r}: failed to query snapshots: {e}")
+                    failed.append(name)
+        if not is_json:
+            return results, failed
+        merged = []
+        for name, snaps in results.items():
+            for snap in snaps:
+                snap.repo = name
+            merged.extend(snaps)
+        merged.sort(key=lambda x: x.time)
+        return merged, failed
 
     def _invoke_profile(self, restic, profile: config.Profile):
+        match profile:
+            case config.CommandProfile(fingerprint=config.FingerprintSpec()):
+                return self._invoke_fingerprinted(restic, profile)
+            case _:
+                return self._invoke_engine(restic, profile)
+
+    def _invoke_fingerprinted(self, restic, profile: config.CommandProfile):
+        """
+        Backs up command output unless it is the same as in the last snapshot.
+        """
+        spec = profile.fingerprint
+        state = self.history.profile(profile.name)
+        cmd = profile.command
+        if isinstance(cmd, str):
+            cmd = cmd.split()
+        stream = StreamFingerprint(
+            cmd,
+            job=self.spawner.job(profile.name),
+            spool_dir=self.config.settings.build_dir / "spool",
+            limit=spec.spool,
+        )
+        # same output stored differently is a different snapshot
+        origin = [
+            self.subsystem,
+            restic.repo.name,
+            profile.command,
+            profile.cli_args,
+        ]
+        with stream:
+            unchanged = stream.fill() and stream.digest == state.get("digest")
+            if unchanged and origin == state.get("origin"):
+                age = time.time() - state.get("snapshot_time", 0)
+                if age < spec.force_after:
+                    self.log.info(
+                        f"Output of {profile.name!r} is unchanged since snapshot "
+                        f"{state.get('snapshot_id')}, skipping backup."
+                    )
+                    return BackupResult(
+                        snapshot_id=state.get("snapshot_id"),
+                        added=0,
+                        duration=stream.job.duration,
+                    )
+                self.log.info(
+                    f"Output of {profile.name!r} is unchanged, "
+                    "forcing backup as the last snapshot is too old."
+                )
+            result = self._invoke_engine(restic, profile, stream=stream)
+        self.history.update_profile(
+            profile.name,
+            digest=stream.digest,
+            origin=origin,
+            snapshot_id=result.snapshot_id,
+            snapshot_time=time.time(),
+        )
+        return result
+
+    def _invoke_engine(self, restic, profile: config.Profile, stream=None):
+        cache_size = self.cache.start(restic.repo) if self.cache else None
         with restic as engine:
-            engine.backup(profile)
-        self.log.info("Backup created successfully.")
+            result = engine.backup(profile, stream=stream)
+        self.log.info(f"Backup of {profile.name!r} created successfully.")
+        if self.cache:
+            self.cache.report(restic.repo, before=cache_size)
+        return result
+
+    @staticmethod
+    def _is_tuned(repo: config.Repository):
+        return isinstance(repo, config.S3Repository) and repo.connections == "auto"
 
     def _profile_for(self, name: str):
         result = self.config.profiles.get(name)
@@ -0,0 +1,110 @@
+from pathlib import Path
+from dataclasses import dataclass
+import os
+import shutil
+
+import humanize
+
+from lohup import config
+from lohup.logger import LoggerProto
+
+
+MARKER = ".lohup-used"
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+@dataclass
+class CacheManager:
+    """
+    Keeps engine cache directories, one per repository,
+    so every profile of the repository reuses the same cache.
+    """
+
+    root: Path
+    budget: int | None
+    log: LoggerProto
+
+    def dir_for(self, repo: config.Repository) -> Path:
+        path = self.root / repo.name
+        path.mkdir(parents=True, exist_ok=True)
+        path.joinpath(MARKER).touch()
+        return path
+
+    def caches(self) -> list[Path]:
+        if not self.root.is_dir():
+            return []
+        return [x for x in self.root.iterdir() if x.is_dir()]
+
+    def enforce(self, keep: set[str] = frozenset()):
+        """
+        Evicts least recently used caches until the total size fits the budget.
+        Caches of repositories in `keep` are never evicted.
+        """
+        if self.budget is None:
+            return
+        sizes = {x: dir_size(x) for x in self.caches()}
+        total = sum(sizes.values())
+        if total <= self.budget:
+            return
+        candidates = sorted(
+            (x for x in sizes if x.name not in keep), key=self._last_used
+        )
+        for path in candidates:
+            if total <= self.budget:
+                break
+            self.log.info(
+                f"Evicting cache of repo {path.name!r} "
+                f"({humanize.naturalsize(sizes[path], binary=True)})"
+            )
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+        if total > self.budget:
+            size = humanize.naturalsize(total, binary=True)
+            self.log.warning(f"Cache size {size} exceeds budget")
+
+    def start(self, repo: config.Repository) -> int:
+        """
+        Returns cache size before a backup, to be passed to `report`.
+        Concurrent backups of the repository each keep their own baseline.
+        """
+        return dir_size(self.dir_for(repo))
+
+    def report(self, repo: config.Repository, before: int):
+        """
+        Logs cache size and how much of it was reused by the backup.
+        Growth of the cache is data the engine had to fetch from the repository.
+        """
+        after = dir_size(self.root / repo.name)
+        fetched = max(after - before, 0)
+        ratio = before / (before + fetched) if before + fetched else 0
+        self.log.info(
+            f"Cache of repo {repo.name!r}: "
+            f"{humanize.naturalsize(after, binary=True)}, "
+            f"fetched {humanize.naturalsize(fetched, binary=True)}, "
+            f"reused {ratio * 100:.1f}%"
+        )
+
+    @staticmethod
+    def _last_used(path: Path) -> float:
+        try:
+            return path.joinpath(MARKER).stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def from_conf(settings: config.Settings, log: LoggerProto):
+        if settings.cache_dir is None:
+            return None
+        return CacheManager(
+            root=settings.cache_dir, budget=settings.cache_size, log=log
+        )
@@ -1,17 +1,27 @@
 import click
 import humanize
-from datetime import datetime
 
 from lohup.app import Lohup
 from lohup import logger
 from lohup.config import ConfigError
+from lohup.snapshot import Snapshot
 
 
 @click.group()
 @click.option("--config", envvar="LOHUP_CONFIG", default="lohup.toml")
+@click.option(
+    "--log-format",
+    envvar="LOHUP_LOG_FORMAT",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    help="Log format, json writes one object per line to stderr",
+)
 @click.pass_context
-def cli(ctx, config):
-    log = logger.CliLogger(level=logger.LogLevel.DEBUG)
+def cli(ctx, config, log_format):
+    if log_format == "json":
+        log = logger.JsonLogger(level=logger.LogLevel.DEBUG)
+    else:
+        log = logger.CliLogger(level=logger.LogLevel.DEBUG)
     ctx.obj = Lohup(config_path=config, logger=log)
     try:
         ctx.obj.load()
@@ -32,73 +42,121 @@ def restic(obj: Lohup, repo, args: tuple[str, ...]):
 
 
 @cli.command()
-@click.argument("profile", required=True, nargs=1)
+@click.argument("profiles", nargs=-1)
+@click.option("--match", multiple=True, help="Glob pattern for profile names")
+@click.option("--tag", "tags", multiple=True, help="Profile tag")
+@click.option("--repo", help="Only profiles stored in this repository")
 @click.pass_obj
-def backup(obj: Lohup, profile: str):
-    obj.backup(profile=profile)
+def backup(obj: Lohup, profiles: tuple[str, ...], match, tags, repo):
+    """
+    Backup selected profiles
+    """
+    if not (profiles or match or tags or repo):
+        raise click.UsageError("Specify profile names or selection options")
+    if len(profiles) == 1 and not (match or tags or repo):
+        return obj.backup(profile=profiles[0])
+    obj.backup_selected(names=profiles, match=match, tags=tags, repo=repo)
 
 
 @cli.command()
+@click.option("--resume", is_flag=True, help="Continue interrupted run")
 @click.pass_obj
-def backup_all(obj: Lohup):
-    obj.backup_all()
+def backup_all(obj: Lohup, resume: bool):
+    obj.backup_all(resume=resume)
 
 
 @cli.command()
-@click.option("--repo", help="Lohup repository name", required=True)
+@click.argument("profiles", nargs=-1)
+@click.pass_obj
+def watch(obj: Lohup, profiles: tuple[str, ...]):
+    """
+    Backup profiles when their paths change
+    """
+    obj.watch(names=profiles)
+
+
+@cli.command()
+@click.option("--from", "source", help="Source repository name", required=True)
+@click.option("--to", "target", help="Target repository name", required=True)
+@click.option("--tag", "tags", multiple=True, help="Only snapshots with the tag")
+@click.option("--jobs", default=4, show_default=True, help="Parallel copies")
+@click.pass_obj
+def sync(obj: Lohup, source: str, target: str, tags: tuple[str, ...], jobs: int):
+    """
+    Copy snapshots missing in target repository
+    """
+    obj.sync(source, target, tags=tags, jobs=jobs)
+
+
+@cli.command()
+@click.option("--repo", help="Lohup repository name, default one if not set")
+@click.option("--all", "all_repos", is_flag=True, help="Query all repositories")
+@click.option("--tag", "tags", multiple=True, help="Only snapshots with the tag")
+@click.option("--host", help="Only snapshots of the host")
+@click.option("--latest", type=int, help="Only last N snapshots per host and paths")
 @click.option("--raw", "raw_mode", is_flag=True)
 @click.pass_obj
-def snapshots(obj: Lohup, repo: str, raw_mode: bool):
-    result = obj.snapshots(repo=repo, is_json=not raw_mode)
-    if raw_mode:
-        return click.echo(result, nl=False)
-    # time, parent?, tree, paths, hostname, uid, gid
-    # tags, version, summary, id, short_id
-    snapshots = []
-    for snap in result:
-        name = "-".join(snap["tags"])
-        dt = datetime.fromisoformat(snap["time"])
-        delta = humanize.naturaltime(datetime.now())
-        summary = snap["summary"]
-        end = datetime.fromisoformat(summary["backup_end"])
-        changes = summary["files_new"] + summary["files_changed"]
-        total_files = summary["total_files_processed"]
-        changes_ratio = changes / total_files if total_files else 0
-        snapshots.append(
-            dict(
-                id=snap["short_id"],
-                name=name,
-                when_started=dt,
-                started_human=delta,
-                hostname=snap["hostname"],
-                duration=end - dt,
-                changes=changes,
-                changes_ratio=changes_ratio,
-                size_comp=summary["data_added_packed"],
-                size_raw=summary["data_added"],
-                processed=summary["total_bytes_processed"],
-            )
-        )
-    snapshots.sort(key=lambda x: x["when_started"])
-    for snap in snapshots:
-        name = click.style(snap["name"], fg="blue", italic=True)
-        click.echo(f"Snapshot {snap['id']} ({name}):")
-        started = humanize.naturaltime(snap["when_started"])
-        text = click.style(started, fg="blue")
-        took = humanize.naturaldelta(snap["duration"])
-        click.echo(f"\tStarted: {text} (took {took})")
-        ratio = snap["changes_ratio"] * 100
-        ratio = click.style(f"{ratio:.1f}%", fg="blue")
-        click.echo(f"\tFiles changed (since previous): {snap['changes']} ({ratio})")
-        size = humanize.naturalsize(snap["size_raw"], binary=True)
-        compressed = humanize.naturalsize(snap["size_comp"], binary=True)
-        total_bytes = snap["processed"]
-        ratio = snap["size_raw"] / total_bytes if total_bytes else 0
-        ratio = click.style(f"{ratio:.1f}%", fg="blue")
-        click.echo(f"\tDiff size: {compressed}, unpacked: {size} ({ratio})")
-        click.echo(f"\tHost: {snap['hostname']}")
-        click.echo()
+def snapshots(
+    obj: Lohup,
+    repo: str | None,
+    all_repos: bool,
+    tags: tuple[str, ...],
+    host: str | None,
+    latest: int | None,
+    raw_mode: bool,
+):
+    if repo and all_repos:
+        raise click.UsageError("--repo and --all are mutually exclusive")
+    if raw_mode and latest is not None and obj.subsystem == "rustic":
+        raise click.UsageError("--latest can't be used with --raw for rustic")
+    filters = dict(is_json=not raw_mode, tags=tags, host=host, latest=latest)
+    failed = []
+    if all_repos:
+        result, failed = obj.snapshots_all(**filters)
+    else:
+        result = obj.snapshots(repo=repo, **filters)
+    if raw_mode and not all_repos:
+        click.echo(result, nl=False)
+    elif raw_mode:
+        for name, text in result.items():
+            click.echo(click.style(f"Repository {name}:", bold=True))
+            click.echo(text, nl=False)
+    else:
+        for snap in sorted(result, key=lambda x: x.time):
+            _render_snapshot(snap)
+    if failed:
+        raise click.ClickException(f"Failed to query repos: {', '.join(failed)}")
 
 
+def _render_snapshot(snap: Snapshot):
+    name = click.style(snap.name, fg="blue", italic=True)
+    repo = f" [{snap.repo}]" if snap.repo else ""
+    click.echo(f"Snapshot {snap.short_id} ({name}){repo}:")
+    started = click.style(humanize.naturaltime(snap.time), fg="blue")
+    summary = snap.summary
+    if summary is None:
+        # old snapshots have no summary
+        click.echo(f"\tStarted: {started}")
+        click.echo(f"\tHost: {snap.hostname}")
+        click.echo()
+        return
+    if summary.backup_end is not None:
+        took = humanize.naturaldelta(summary.backup_end - snap.time)
+        click.echo(f"\tStarted: {started} (took {took})")
+    else:
+        click.echo(f"\tStarted: {started}")
+    total_files = summary.total_files
+    ratio = summary.changes / total_files * 100 if total_files else 0
+    ratio = click.style(f"{ratio:.1f}%", fg="blue")
+    click.echo(f"\tFiles changed (since previous): {summary.changes} ({ratio})")
+    size = humanize.naturalsize(summary.data_added, binary=True)
+    compressed = humanize.naturalsize(summary.data_added_packed, binary=True)
+    total_bytes = summary.total_bytes
+    ratio = summary.data_added / total_bytes if total_bytes else 0
+    ratio = click.style(f"{ratio:.1f}%", fg="blue")
+    click.echo(f"\tDiff size: {compressed}, unpacked: {size} ({ratio})")
+    click.echo(f"\tHost: {snap.hostname}")
+    click.echo()
+
 if __name__ == "__main__":
     cli()
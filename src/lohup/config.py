@@ -1,9 +1,13 @@
+import fnmatch
+import glob
 import platform
+import re
+import subprocess as procs
 import tomllib
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
-from lohup.util import catch_errors, ensure_exists, CatcherError, Masked
+from lohup.util import catch_errors, ensure_exists, parse_size, CatcherError, Masked
 from lohup.expander import VarExpander
 from lohup.logger import LogLevel
 
@@ -18,6 +22,16 @@ class Settings:
     globalvars: dict[str, str]
     build_dir: Path
     subsystem: str
+    cache_dir: Path | None = None
+    cache_size: int | None = None
+    output_tail: int = 50
+    # profiles backed up concurrently
+    jobs: int = 1
+    memory_budget: int | None = None
+    memory_cgroup: bool = False
+    gogc: int | None = None
+    state_dir: Path | None = None
+    progress_interval: float = 10.0
 
     @staticmethod
     def load(conf: dict):
@@ -37,13 +51,36 @@ class Settings:
                 build_dir=tmp_path,
                 subsystem=conf.get("subsystem-name", "restic"),
             )
+            match cache_dir := conf.get("cache-dir"):
+                case False:
+                    pass
+                case None | True:
+                    settings.cache_dir = tmp_path / "cache"
+                case _:
+                    settings.cache_dir = Path(cache_dir)
+            settings.state_dir = Path(conf.get("state-dir", tmp_path / "state"))
+            settings.output_tail = conf.get("output-tail", settings.output_tail)
+            settings.progress_interval = conf.get(
+                "progress-interval", settings.progress_interval
+            )
+            settings.jobs = conf.get("jobs", settings.jobs)
+            if settings.jobs < 1:
+                catch.error("field 'jobs': must be positive")
+            settings.memory_cgroup = conf.get("memory-cgroup", False)
+            settings.gogc = conf.get("gogc")
+            if (size := conf.get("memory-budget")) is not None:
+                settings.memory_budget = catch.catch(
+                    lambda: parse_size(size), prefix="field 'memory-budget':"
+                )
+            if (size := conf.get("cache-size")) is not None:
+                settings.cache_size = catch.catch(
+                    lambda: parse_size(size), prefix="field 'cache-size':"
+                )
             settings.globalvars["BDIR"] = str(basepath)
             settings.globalvars["BUILDDIR"] = str(settings.build_dir)
-            for key, value in settings.globalvars.items():
-                if "$" in value:
-                    catch.error(
-                        f"variable {key!r}: nested references in globals are not allowed"
-                    )
+            resolved = catch.catch(lambda: VarExpander.resolve(settings.globalvars))
+            if resolved is not None:
+                settings.globalvars = resolved
         return settings
 
 
@@ -53,6 +90,8 @@ class LocalRepository:
     path: str
     repo_key_file: Masked
     default: bool
+    replicate_to: str | None = None
+    replicate_background: bool = False
 
     @staticmethod
     def load(name: str, conf: dict, expander: VarExpander):
@@ -62,6 +101,8 @@ class LocalRepository:
                 path=expander.expand(conf.get("path")),
                 repo_key_file=Masked(expander.expand(conf.get("repo-key-file", ""))),
                 default=conf.get("default", False),
+                replicate_to=conf.get("replicate-to"),
+                replicate_background=conf.get("replicate-background", False),
             )
             if not repo.path:
                 catcher.error("field 'path' not set")
@@ -81,6 +122,11 @@ class S3Repository:
     bucket: str
     path: str
     default: bool
+    replicate_to: str | None = None
+    replicate_background: bool = False
+    # int or "auto"
+    connections: int | str | None = None
+    read_concurrency: int | None = None
 
     @staticmethod
     def load(name: str, conf: dict, expander: VarExpander):
@@ -94,12 +140,30 @@ class S3Repository:
             bucket=expander.expand(conf.get("bucket", "")),
             path=expander.expand(conf.get("path", "/")),
             default=conf.get("default", False),
+            replicate_to=conf.get("replicate-to"),
+            replicate_background=conf.get("replicate-background", False),
+            connections=conf.get("connections"),
+            read_concurrency=conf.get("read-concurrency"),
         )
         with catch_errors() as catcher:
             if not repo.endpoint:
                 catcher.error("field 'endpoint': not set")
             if not repo.bucket:
                 catcher.error("field 'bucket': not set")
+            match repo.connections:
+                case None | "auto":
+                    pass
+                case int(x) if x > 0:
+                    pass
+                case x:
+                    catcher.error(f"field 'connections': invalid value {x!r}")
+            match repo.read_concurrency:
+                case None:
+                    pass
+                case int(x) if x > 0:
+                    pass
+                case x:
+                    catcher.error(f"field 'read-concurrency': invalid value {x!r}")
             if value := repo.access_key_file.value:
                 if msg := ensure_exists(value, field="access-key-file"):
                     catcher.error(msg)
@@ -119,6 +183,7 @@ class CommandHook:
     command: str
     hook_kind: str
 
+    @staticmethod
     def load(conf: dict, kind: str, expander: VarExpander):
         return CommandHook(command=expander.expand(conf.get("command")), hook_kind=kind)
 
@@ -148,48 +213,92 @@ class HookSet:
     before_all: list[Hook]
     after_all: list[Hook]
 
+    KINDS = {"command": CommandHook, "btrfs": BtrfsHook}
+
     @staticmethod
     def load(conf: dict, expander: VarExpander):
         with catch_errors() as catcher:
-            before_all = []
-            after_all = []
-            for hook in conf.get("before-all", []):
-                match kind := hook.get("kind"):
-                    case "command":
-                        catcher.catch(
-                            lambda: before_all.append(
-                                CommandHook.load(hook, kind=kind, expander=expander)
-                            ),
-                            prefix="before-all command:",
-                        )
-                    case "btrfs":
-                        catcher.catch(
-                            lambda: before_all.append(
-                                BtrfsHook.load(hook, kind=kind, expander=expander)
-                            ),
-                            prefix="before-all btrfs:",
-                        )
-                    case _:
-                        catcher.error(f"Unsupported before-all: {kind}")
-            for hook in conf.get("after-all", []):
-                match kind := hook.get("kind"):
-                    case "command":
-                        catcher.catch(
-                            lambda: after_all.append(
-                                CommandHook.load(hook, kind=kind, expander=expander)
-                            ),
-                            prefix="after-all command:",
-                        )
-                    case "btrfs":
-                        catcher.catch(
-                            lambda: after_all.append(
-                                BtrfsHook.load(hook, kind=kind, expander=expander)
-                            ),
-                            prefix="after-all btrfs:",
-                        )
-                    case _:
-                        catcher.error(f"after-all: unknown kind {kind!r}")
-            return HookSet(before_all=before_all, after_all=after_all)
+            sections = {}
+            for section in ("before-all", "after-all"):
+                sections[section] = HookSet._load_section(
+                    conf.get(section, []), section, catcher, expander
+                )
+            return HookSet(
+                before_all=sections["before-all"], after_all=sections["after-all"]
+            )
+
+    @staticmethod
+    def _load_section(hooks: list[dict], section: str, catcher, expander):
+        out = []
+        for hook in hooks:
+            kind = hook.get("kind")
+            if (cls := HookSet.KINDS.get(kind)) is None:
+                catcher.error(f"Unsupported {section}: {kind}")
+                continue
+            catcher.catch(
+                lambda: out.append(cls.load(hook, kind=kind, expander=expander)),
+                prefix=f"{section} {kind}:",
+            )
+        return out
+
+
+@dataclass
+class WatchSpec:
+    # changed files or bytes which make backup due
+    changes: int
+    bytes: int | None
+    # backup is postponed until paths are quiet for this many seconds...
+    debounce: float
+    # ...unless first change is older than this
+    max_delay: float
+    # minimal pause between two backups
+    min_interval: float
+    # directories watched instead of profile paths, which may be
+    # inside a snapshot existing only while backup runs
+    paths: list[str] = field(default_factory=list)
+
+    @staticmethod
+    def load(conf: dict):
+        with catch_errors() as catcher:
+            spec = WatchSpec(
+                changes=conf.get("changes", 100),
+                bytes=None,
+                debounce=conf.get("debounce", 30),
+                max_delay=conf.get("max-delay", 3600),
+                min_interval=conf.get("min-interval", 300),
+            )
+            if (size := conf.get("bytes")) is not None:
+                spec.bytes = catcher.catch(
+                    lambda: parse_size(size), prefix="field 'bytes':"
+                )
+            if spec.changes < 1:
+                catcher.error("field 'changes': must be positive")
+            if spec.max_delay < spec.debounce:
+                catcher.error("field 'max-delay': must not be less than 'debounce'")
+        return spec
+
+
+@dataclass
+class FingerprintSpec:
+    # producer output compared before the engine is started, bytes
+    spool: int
+    # unchanged output is still backed up after this many seconds
+    force_after: float
+
+    @staticmethod
+    def load(conf: dict):
+        with catch_errors() as catcher:
+            spec = FingerprintSpec(
+                spool=64 * 1024**2,
+                force_after=conf.get("force-after", 7 * 86400),
+            )
+            if (size := conf.get("spool")) is not None:
+                spec.spool = catcher.catch(
+                    lambda: parse_size(size), prefix="field 'spool':"
+                )
+            if spec.force_after < 0:
+                catcher.error("field 'force-after': must not be negative")
+        return spec
 
 
 @dataclass
@@ -199,6 +308,10 @@ class PathsProfile:
     paths: list[str]
     exclude_paths: list[str]
     cli_args: list[str]
+    tags: list[str] = field(default_factory=list)
+    # memory limit of the engine process, bytes
+    memory: int | None = None
+    watch: WatchSpec | None = None
 
 
 @dataclass
@@ -207,11 +320,148 @@ class CommandProfile:
     repo: str | None
     command: str | list[str]
     cli_args: list[str]
+    tags: list[str] = field(default_factory=list)
+    # memory limit of the engine process, bytes
+    memory: int | None = None
+    # skips the engine when output is the same as in the last snapshot
+    fingerprint: FingerprintSpec | None = None
 
 
 Profile = PathsProfile | CommandProfile
 
 
+def _profile_instances(
+    name: str, opts: dict, expander: VarExpander
+) -> list[tuple[str, dict[str, str]]]:
+    """
+    Returns names and variables of profiles produced by profile definition.
+    Definition with "for-each" table is a template expanded over each item
+    of a glob, list or command output lines. Item value is available as
+    $ITEM (or the name set in "var"), for globs it is the basename of
+    the match, and the full path is $ITEM_PATH.
+    """
+    spec = opts.get("for-each")
+    if spec is None:
+        return [(name, {})]
+    var = spec.get("var", "ITEM")
+    match spec:
+        case {"glob": str(pattern)}:
+            matches = sorted(glob.glob(expander.expand(pattern)))
+            items = [(Path(x).name, {f"{var}_PATH": x}) for x in matches]
+        case {"list": list(values)}:
+            items = [(str(x), {}) for x in values]
+        case {"command": str(cmd) | list(cmd)}:
+            if isinstance(cmd, str):
+                cmd = expander.expand(cmd, strict=False).split()
+            output = procs.check_output(cmd, encoding="utf-8")
+            items = [(x.strip(), {}) for x in output.splitlines() if x.strip()]
+        case _:
+            raise ValueError("for-each: one of 'glob', 'list' or 'command' required")
+    out = []
+    for value, variables in items:
+        variables[var] = value
+        instance = expander.expand(name, variables)
+        if instance == name:
+            raise ValueError(f"template name must reference ${var}")
+        out.append((instance, variables))
+    return out
+
+
+def _load_profile(
+    name: str, opts: dict, expander: VarExpander, variables: dict[str, str]
+) -> Profile:
+    with catch_errors() as catcher:
+        # profile variables may reference globals, template variables
+        # and variables defined before them
+        variables = dict(variables)
+        for key, value in opts.get("vars", {}).items():
+            variables[key] = expander.expand(value, variables)
+        args = opts.get("cli-args", [])
+        tags = [expander.expand(x, variables) for x in opts.get("tags", [])]
+        memory = None
+        if (size := opts.get("memory")) is not None:
+            memory = catcher.catch(lambda: parse_size(size), prefix="field 'memory':")
+        if cmd := opts.get("command"):
+            # commands may reference shell variables, those are kept as is
+            if isinstance(cmd, str):
+                cmd = expander.expand(cmd, variables, strict=False)
+            else:
+                cmd = [expander.expand(x, variables, strict=False) for x in cmd]
+            profile = CommandProfile(
+                name,
+                repo=opts.get("repo"),
+                command=cmd,
+                cli_args=args,
+                tags=tags,
+                memory=memory,
+            )
+            match opts.get("fingerprint"):
+                case None | False:
+                    pass
+                case True:
+                    profile.fingerprint = FingerprintSpec.load({})
+                case dict(spec):
+                    profile.fingerprint = catcher.catch(
+                        lambda: FingerprintSpec.load(spec), prefix="fingerprint:"
+                    )
+                case _:
+                    catcher.error("field 'fingerprint': must be a boolean or table")
+            return profile
+        paths = opts.get("paths")
+        if not paths:
+            catcher.error("no paths or command provided")
+            return
+        profile = PathsProfile(
+            name,
+            repo=opts.get("repo"),
+            paths=[expander.expand(x, variables) for x in paths],
+            exclude_paths=[
+                expander.expand(x, variables) for x in opts.get("exclude-paths", [])
+            ],
+            cli_args=args,
+            tags=tags,
+            memory=memory,
+        )
+        if watch := opts.get("watch"):
+            profile.watch = catcher.catch(
+                lambda: WatchSpec.load(watch), prefix="watch:"
+            )
+            if profile.watch is not None:
+                profile.watch.paths = [
+                    expander.expand(x, variables) for x in watch.get("paths", [])
+                ]
+    return profile
+
+
+def _merge_conf(dst: dict, src: dict, origin: str, catcher, own: dict, section=None):
+    """
+    Merges included TOML document into the main one in place.
+    Tables are merged recursively, arrays (like hooks) are concatenated,
+    repos and profiles must not be redefined. Values set by the including
+    file itself (keys in `own`) win, two includes must not set one value.
+    """
+    for key, value in src.items():
+        current = dst.get(key)
+        if current is None:
+            dst[key] = value
+        elif section in ("repos", "profiles"):
+            catcher.error(f"{origin}: {section[:-1]} {key!r} is already defined")
+        elif isinstance(current, dict) and isinstance(value, dict):
+            nested = own.get(key) or {}
+            _merge_conf(current, value, origin, catcher, own=nested, section=key)
+        elif isinstance(current, list) and isinstance(value, list):
+            current.extend(value)
+        elif key not in own and current != value:
+            catcher.error(f"{origin}: {key!r} is already set by another include")
+
+
+def _own_keys(conf: dict) -> dict:
+    """
+    Returns nested tables of `conf` with keys only, before includes are merged.
+    """
+    return {k: _own_keys(v) if isinstance(v, dict) else None for k, v in conf.items()}
+
+
 @dataclass
 class TomlConfig:
     settings: Settings
@@ -219,6 +469,56 @@ class TomlConfig:
     hooks: HookSet
     expander: VarExpander
     profiles: dict[str, Profile]
+    default_repo: Repository | None = field(default=None, init=False)
+    profile_repos: dict[str, Repository | None] = field(
+        default_factory=dict, init=False
+    )
+    tagged: dict[str, list[Profile]] = field(default_factory=dict, init=False)
+
+    def __post_init__(self):
+        # configs may be generated with hundreds of profiles,
+        # so lookups are resolved once here instead of on every call
+        for repo in self.repos.values():
+            if repo.default:
+                self.default_repo = repo
+        for name, profile in self.profiles.items():
+            if profile.repo is None:
+                self.profile_repos[name] = self.default_repo
+            else:
+                self.profile_repos[name] = self.repos.get(profile.repo)
+            for tag in profile.tags:
+                self.tagged.setdefault(tag, []).append(profile)
+
+    def select(
+        self,
+        patterns: tuple[str, ...] = (),
+        tags: tuple[str, ...] = (),
+        repo: str | None = None,
+    ) -> list[Profile]:
+        """
+        Returns profiles matching any of the glob patterns and any of the tags,
+        optionally limited to ones backed up into repository `repo`.
+        Result preserves definition order.
+        """
+        if repo is not None and repo not in self.repos:
+            raise KeyError(f"Unknown repo: {repo}")
+        selected = self.profiles.values()
+        if patterns:
+            exact = {x for x in patterns if not any(c in x for c in "*?[")}
+            globs = [fnmatch.translate(x) for x in patterns if x not in exact]
+            regex = re.compile("|".join(globs)) if globs else None
+            selected = [
+                x
+                for x in selected
+                if x.name in exact or (regex is not None and regex.match(x.name))
+            ]
+        if tags:
+            names = {x.name for tag in tags for x in self.tagged.get(tag, [])}
+            selected = [x for x in selected if x.name in names]
+        if repo is not None:
+            target = self.repos[repo]
+            selected = [x for x in selected if self.profile_repos[x.name] is target]
+        return list(selected)
 
     @staticmethod
     def from_file(name: str, logger):
@@ -229,13 +529,38 @@ class TomlConfig:
         except CatcherError as e:
             raise ConfigError("Failed to parse TOML config") from e
 
+    @staticmethod
+    def _read(path: Path, catcher, seen: set[Path]) -> dict:
+        with path.open("rb") as fp:
+            conf: dict = tomllib.load(fp)
+        seen.add(path.resolve())
+        includes = conf.pop("include", [])
+        if isinstance(includes, str):
+            includes = [includes]
+        own = _own_keys(conf)
+        for pattern in includes:
+            origin = f"include {pattern!r}:"
+            if any(c in pattern for c in "*?["):
+                found = sorted(path.parent.glob(pattern))
+            else:
+                found = [path.parent / pattern]
+                if not found[0].exists():
+                    catcher.error(f"{origin} file does not exist")
+                    continue
+            for child in found:
+                # every file is parsed once, which also breaks include cycles
+                if child.resolve() in seen:
+                    continue
+                extra = TomlConfig._read(child, catcher, seen)
+                _merge_conf(conf, extra, origin, catcher, own=own)
+        return conf
+
     @staticmethod
     def _ffile_impl(name: str, path: Path, catcher):
         if not path.exists():
             catcher.error(f"Config {name!r} does not exist")
             return
-        with path.open("rb") as fp:
-            conf: dict = tomllib.load(fp)
+        conf = TomlConfig._read(path, catcher, seen=set())
         settings = Settings.load({})
         if value := conf.get("settings"):
             settings = catcher.catch(lambda: Settings.load(value), prefix="settings:")
@@ -262,32 +587,37 @@ class TomlConfig:
                     catcher.error(f"{error_prefix} unsupported kind: {kind}")
         if not repos:
             catcher.error("no repositories defined")
-        hooks = None
+        for name, repo in repos.items():
+            if repo is None or repo.replicate_to is None:
+                continue
+            if repo.replicate_to not in repos or repo.replicate_to == name:
+                catcher.error(
+                    f"repo {name!r}: field 'replicate-to': "
+                    f"invalid repository {repo.replicate_to!r}"
+                )
+        hooks = HookSet(before_all=[], after_all=[])
         if hook_conf := conf.get("hooks"):
             hooks = catcher.catch(
                 lambda: HookSet.load(hook_conf, expander=expander), prefix="hook:"
             )
         profiles = {}
-        for name, opts in conf.get("profiles", {}).items():
-            args = opts.get("cli-args", [])
-            if cmd := opts.get("command"):
-                profiles[name] = CommandProfile(
-                    name, repo=opts.get("repo"), command=cmd, cli_args=args
-                )
-            else:
-                paths = opts.get("paths")
-                if not paths:
-                    catcher.error(f"profile {name!r}: no paths or command provided")
+        for template, opts in conf.get("profiles", {}).items():
+            instances = catcher.catch(
+                lambda: _profile_instances(template, opts, expander),
+                prefix=f"profile {template!r}:",
+            )
+            for name, variables in instances or ():
+                if name in profiles:
+                    catcher.error(f"profile {name!r}: already defined")
                     continue
-                profiles[name] = PathsProfile(
-                    name,
-                    repo=opts.get("repo"),
-                    paths=[expander.expand(x) for x in paths],
-                    exclude_paths=[
-                        expander.expand(x) for x in opts.get("exclude-paths", [])
-                    ],
-                    cli_args=args,
+                profile = catcher.catch(
+                    lambda: _load_profile(name, opts, expander, variables),
+                    prefix=f"profile {name!r}:",
                 )
+                if profile is not None:
+                    profiles[name] = profile
+        if catcher.errorlist:
+            return
         toml = TomlConfig(
             settings=settings,
             repos=repos,
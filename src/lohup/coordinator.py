@@ -0,0 +1,134 @@
+from pathlib import Path
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import time
+
+from lohup.logger import LoggerProto
+
+
+@dataclass
+class Claim:
+    """
+    Profiles this invocation has to back up itself, and results of ones
+    backed up by concurrent invocations while this one was waiting.
+    """
+
+    coordinator: "Coordinator"
+    names: list[str]
+    coalesced: dict[str, str | None] = field(default_factory=dict)
+    _locks: dict[str, int] = field(default_factory=dict)
+
+    def record(self, name: str, snapshot_id: str | None):
+        """
+        Publishes successful backup of profile for invocations waiting for it.
+        """
+        result = {
+            "snapshot_id": snapshot_id,
+            "finished": time.time(),
+            "pid": os.getpid(),
+        }
+        path = self.coordinator.result_file(name)
+        tmp = path.with_name(f"{path.name}.tmp")
+        tmp.write_text(json.dumps(result))
+        tmp.replace(path)
+
+
+@dataclass
+class Coordinator:
+    """
+    Serializes lohup runs on the host with lock files in the build dir.
+
+    Every run holds locks of the profiles it is going to back up, then waits
+    for the run lock. Another run requesting a locked profile waits until
+    the lock is released and takes the result published by the holder,
+    instead of backing the profile up again. Waiting for other runs always
+    happens while holding no locks, so runs can't deadlock.
+    """
+
+    root: Path
+    log: LoggerProto
+
+    def result_file(self, name: str) -> Path:
+        return self.root / f"{self._filename(name)}.result"
+
+    @contextmanager
+    def claim(self, names: list[str], exclusive: bool = False):
+        """
+        With `exclusive` the run lock is held even when nothing is left
+        to back up, for callers reading or writing run-wide state.
+        """
+        claim = self._acquire(names, exclusive)
+        try:
+            yield claim
+        finally:
+            self._release(claim)
+
+    def _acquire(self, names: list[str], exclusive: bool) -> Claim:
+        self.root.mkdir(parents=True, exist_ok=True)
+        requested = time.time()
+        claim = Claim(self, names=[])
+        remaining = list(dict.fromkeys(names))
+        while remaining:
+            busy = []
+            for name in remaining:
+                fd = self._lock(self._lockfile(name), blocking=False)
+                if fd is None:
+                    busy.append(name)
+                else:
+                    claim._locks[name] = fd
+            if not busy:
+                break
+            # release everything before waiting, other runs may wait for us
+            self._release(claim)
+            for name in busy:
+                self.log.info(f"Profile {name!r} is being backed up by another run")
+                self._unlock(self._lock(self._lockfile(name), blocking=True))
+                if (result := self._result(name, since=requested)) is not None:
+                    claim.coalesced[name] = result.get("snapshot_id")
+            remaining = [x for x in remaining if x not in claim.coalesced]
+        claim.names = [x for x in names if x in claim._locks]
+        if claim.names or exclusive:
+            run_lock = self._lock(self.root / "run.lock", blocking=False)
+            if run_lock is None:
+                self.log.info("Waiting for another lohup run to finish")
+                run_lock = self._lock(self.root / "run.lock", blocking=True)
+            claim._locks[""] = run_lock
+        return claim
+
+    def _result(self, name: str, since: float) -> dict | None:
+        try:
+            result = json.loads(self.result_file(name).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        return result if result["finished"] >= since else None
+
+    def _release(self, claim: Claim):
+        for fd in claim._locks.values():
+            self._unlock(fd)
+        claim._locks.clear()
+
+    def _lockfile(self, name: str) -> Path:
+        return self.root / f"{self._filename(name)}.lock"
+
+    @staticmethod
+    def _filename(name: str) -> str:
+        return "profile-" + name.replace("/", "_")
+
+    @staticmethod
+    def _lock(path: Path, blocking: bool) -> int | None:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            fcntl.flock(fd, flags)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
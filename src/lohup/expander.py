@@ -1,27 +1,81 @@
 from dataclasses import dataclass
+from functools import lru_cache
 import re
 
 
+_PATTERN = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+
+
+@lru_cache(maxsize=4096)
+def _compile(text: str) -> tuple[tuple[bool, str, str], ...]:
+    """
+    Splits text into (is_variable, literal or name, source text) parts:
+    "/home/$USER" -> ((False, "/home/", "/home/"), (True, "USER", "$USER"))
+    """
+    parts = []
+    pos = 0
+    for match in _PATTERN.finditer(text):
+        if match.start() > pos:
+            literal = text[pos : match.start()]
+            parts.append((False, literal, literal))
+        parts.append((True, match.group(1) or match.group(2), match.group(0)))
+        pos = match.end()
+    if pos < len(text):
+        parts.append((False, text[pos:], text[pos:]))
+    return tuple(parts)
+
+
 @dataclass
 class VarExpander:
     globalvars: dict[str, str]
-    _PATTERN = re.compile(r"(\$([\w_]+)[^\w_/$]*)+")
 
-    def expand(self, text: str | None, extras: dict[str, str] | None = None):
+    def expand(
+        self, text: str | None, extras: dict[str, str] | None = None, strict=True
+    ):
+        """
+        Substitutes variables in `text`. Undefined variables are an error,
+        unless `strict` is off, then they are left for the shell to expand.
+        """
         if not text or "$" not in text:
             return text
-        all_vars = self.globalvars.copy()
-        if extras:
-            all_vars.update(extras)
-        match = self._PATTERN.findall(text)
-        if not match:
-            return
-        for var, name in match:
-            value = all_vars.get(name)
-            if not value:
-                raise KeyError(f"variable {var} is not defined")
-            text = text.replace(var, value)
-        return text
+        out = []
+        for is_var, part, source in _compile(text):
+            if not is_var:
+                out.append(part)
+                continue
+            value = extras.get(part) if extras else None
+            if value is None:
+                value = self.globalvars.get(part)
+            if value is None and not strict:
+                value = source
+            elif value is None:
+                raise KeyError(f"variable ${part} is not defined")
+            out.append(value)
+        return "".join(out)
+
+    @staticmethod
+    def resolve(variables: dict[str, str]) -> dict[str, str]:
+        """
+        Expands variables referencing each other, in dependency order.
+        """
+        resolved = {}
+        expander = VarExpander(globalvars=resolved)
+
+        def visit(name: str, chain: tuple[str, ...]):
+            if name in resolved:
+                return
+            if name in chain:
+                cycle = " -> ".join(chain[chain.index(name) :] + (name,))
+                raise KeyError(f"variable ${name}: circular reference {cycle}")
+            value = variables[name]
+            for is_var, part, _ in _compile(value):
+                if is_var and part in variables:
+                    visit(part, chain + (name,))
+            resolved[name] = expander.expand(value)
+
+        for name in variables:
+            visit(name, ())
+        return resolved
 
     @staticmethod
     def from_conf(settings):
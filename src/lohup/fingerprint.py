@@ -0,0 +1,90 @@
+from pathlib import Path
+from dataclasses import dataclass, field
+import hashlib
+import subprocess as procs
+import tempfile
+
+from lohup.output import Job, Spawner
+
+
+CHUNK_SIZE = 64 * 1024
+# spool is kept in memory up to this size, then moved to the disk
+MEMORY_SPOOL = 8 * 1024**2
+
+
+@dataclass
+class StreamFingerprint:
+    """
+    Output of command profile's producer, hashed as it is read.
+    Output is spooled up to `limit` bytes, so it can be compared with
+    the previous one before the engine is started. Longer output is
+    streamed to the engine right away and only hashed for the next run.
+    """
+
+    cmd: list[str]
+    job: Job
+    spool_dir: Path
+    limit: int
+    complete: bool = field(default=False)
+    _hash: object = field(default_factory=hashlib.sha256)
+    _spool: tempfile.SpooledTemporaryFile | None = field(default=None)
+    _proc: procs.Popen | None = field(default=None)
+
+    @property
+    def digest(self) -> str | None:
+        return self._hash.hexdigest() if self.complete else None
+
+    def fill(self) -> bool:
+        """
+        Spools producer output, returns whether it fit the limit.
+        """
+        size = 0
+        while chunk := self._proc.stdout.read(CHUNK_SIZE):
+            self._hash.update(chunk)
+            self._spool.write(chunk)
+            size += len(chunk)
+            if size >= self.limit:
+                return False
+        self._finish()
+        return True
+
+    def chunks(self):
+        """
+        Yields spooled output, then the rest of the stream.
+        """
+        self._spool.seek(0)
+        while chunk := self._spool.read(CHUNK_SIZE):
+            yield chunk
+        if self.complete:
+            return
+        while chunk := self._proc.stdout.read(CHUNK_SIZE):
+            self._hash.update(chunk)
+            yield chunk
+        self._finish()
+
+    def _finish(self):
+        Spawner._wait(self.job, self._proc)
+        if self._proc.returncode:
+            self.job.dump()
+            raise procs.CalledProcessError(self._proc.returncode, self.cmd)
+        self.complete = True
+
+    def __enter__(self):
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._spool = tempfile.SpooledTemporaryFile(
+            max_size=min(self.limit, MEMORY_SPOOL), dir=self.spool_dir
+        )
+        self._proc = procs.Popen(
+            self.cmd, stdin=procs.DEVNULL, stdout=procs.PIPE, stderr=procs.PIPE
+        )
+        self.job.attach(self._proc.stderr)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+        self.job.join()
+        self._spool.close()
+        return False
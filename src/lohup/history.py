@@ -0,0 +1,68 @@
+from pathlib import Path
+from dataclasses import dataclass, field
+import json
+import os
+import threading
+
+
+@dataclass
+class History:
+    """
+    State kept between runs in the state dir: measurements and values
+    learned from previous runs, per repository and per profile.
+    """
+
+    path: Path
+    repos: dict[str, dict] = field(default_factory=dict)
+    profiles: dict[str, dict] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def repo(self, name: str) -> dict:
+        """
+        Returns copy of the repository state, use update_repo to change it.
+        """
+        with self._lock:
+            return dict(self.repos.get(name, {}))
+
+    def profile(self, name: str) -> dict:
+        """
+        Returns copy of the profile state, use update_profile to change it.
+        """
+        with self._lock:
+            return dict(self.profiles.get(name, {}))
+
+    def update_repo(self, name: str, **values):
+        with self._lock:
+            self.repos.setdefault(name, {}).update(values)
+
+    def update_profile(self, name: str, **values):
+        with self._lock:
+            self.profiles.setdefault(name, {}).update(values)
+
+    def reload(self):
+        """
+        Re-reads state saved by other runs, unsaved changes are dropped.
+        """
+        fresh = History.load(self.path)
+        with self._lock:
+            self.repos, self.profiles = fresh.repos, fresh.profiles
+
+    def save(self):
+        with self._lock:
+            data = json.dumps({"repos": self.repos, "profiles": self.profiles})
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            with tmp.open("w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            tmp.replace(self.path)
+
+    @staticmethod
+    def load(path: Path):
+        if not path.exists():
+            return History(path)
+        data = json.loads(path.read_text())
+        return History(
+            path, repos=data.get("repos", {}), profiles=data.get("profiles", {})
+        )
@@ -0,0 +1,67 @@
+from pathlib import Path
+from dataclasses import dataclass, field
+from datetime import datetime
+import json
+import os
+import threading
+
+
+@dataclass
+class Journal:
+    """
+    Progress of a backup-all run, saved to the build dir after every step
+    so an interrupted run can be resumed.
+    """
+
+    path: Path
+    started: str = field(default_factory=lambda: datetime.now().isoformat())
+    # hook section name -> indexes of hooks done
+    hooks: dict[str, list[int]] = field(default_factory=dict)
+    # profile name -> snapshot ID, if it was detected
+    completed: dict[str, str | None] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def hook_done(self, section: str, index: int):
+        with self._lock:
+            self.hooks.setdefault(section, []).append(index)
+            self._save()
+
+    def is_hook_done(self, section: str, index: int) -> bool:
+        with self._lock:
+            return index in self.hooks.get(section, [])
+
+    def reset_hooks(self, section: str):
+        with self._lock:
+            self.hooks.pop(section, None)
+            self._save()
+
+    def profile_done(self, name: str, snapshot_id: str | None):
+        with self._lock:
+            self.completed[name] = snapshot_id
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        # profiles complete concurrently, callers hold the lock
+        # so the state doesn't change while it is serialized
+        data = dict(started=self.started, hooks=self.hooks, completed=self.completed)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp.open("w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.path)
+
+    def finish(self):
+        self.path.unlink(True)
+
+    @staticmethod
+    def load(path: Path):
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text())
+        return Journal(path=path, **data)
@@ -1,7 +1,12 @@
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
 import click
+import json
 import logging
 import enum
+import sys
+import threading
+import time
 
 
 class LogLevel(enum.IntEnum):
@@ -13,9 +18,30 @@ class LogLevel(enum.IntEnum):
     TRACE = 5
 
 
+@dataclass
+class RateLimiter:
+    """
+    Lets through at most one message per `interval` seconds for every source.
+    """
+
+    interval: float = field(default=10.0)
+    _last: dict[str, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def allow(self, source: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(source)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[source] = now
+            return True
+
+
 @dataclass
 class CliLogger:
     level: LogLevel = field(default=LogLevel.INFO)
+    limiter: RateLimiter = field(default_factory=RateLimiter)
 
     def error(self, msg):
         if self.level <= LogLevel.ERROR:
@@ -41,6 +67,68 @@ class CliLogger:
             msg = (click.style("[debug]", fg="white"), msg)
             click.echo(" ".join(msg))
 
+    def output(self, source: str, line: str):
+        if self.level <= LogLevel.INFO:
+            click.echo(f"{click.style(source, fg='cyan')} | {line}")
+
+    def progress(self, source: str, line: str):
+        if self.limiter.allow(source):
+            self.output(source, line)
+
+    def accepts(self, level):
+        return self.level <= level
+
+
+@dataclass
+class JsonLogger:
+    """
+    Writes every message as a JSON object on its own line to stderr.
+    """
+
+    level: LogLevel = field(default=LogLevel.INFO)
+    limiter: RateLimiter = field(default_factory=RateLimiter)
+    stream: object = field(default=None)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def _write(self, level: LogLevel, msg, source: str | None = None):
+        if self.level > level:
+            return
+        if isinstance(msg, Exception):
+            import traceback
+
+            msg = "".join(traceback.format_exception(msg))
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "level": level.name.lower(),
+            "msg": str(msg),
+        }
+        if source is not None:
+            record["source"] = source
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            stream = self.stream or sys.stderr
+            stream.write(line + "\n")
+            stream.flush()
+
+    def error(self, msg):
+        self._write(LogLevel.ERROR, msg)
+
+    def warning(self, msg):
+        self._write(LogLevel.WARNING, msg)
+
+    def info(self, msg):
+        self._write(LogLevel.INFO, msg)
+
+    def debug(self, msg):
+        self._write(LogLevel.DEBUG, msg)
+
+    def output(self, source: str, line: str):
+        self._write(LogLevel.INFO, line, source=source)
+
+    def progress(self, source: str, line: str):
+        if self.limiter.allow(source):
+            self.output(source, line)
+
     def accepts(self, level):
         return self.level <= level
 
@@ -50,9 +138,10 @@ class BasicLogger:
     LEVEL_INFO = logging.INFO
     LEVEL_ERROR = logging.ERROR
 
-    def __init__(self, level=LogLevel.DEBUG):
+    def __init__(self, level=LogLevel.DEBUG, limiter: RateLimiter | None = None):
         self.level = level
         self.logger = logging.Logger("lohup", level=level.value)
+        self.limiter = limiter or RateLimiter()
 
     def error(self, msg):
         if isinstance(msg, Exception):
@@ -69,8 +158,15 @@ class BasicLogger:
     def debug(self, msg):
         self.logger.debug(msg)
 
+    def output(self, source: str, line: str):
+        self.logger.info("%s | %s", source, line)
+
+    def progress(self, source: str, line: str):
+        if self.limiter.allow(source):
+            self.output(source, line)
+
     def accepts(self, level):
         return self.level <= level
 
 
-LoggerProto = CliLogger | BasicLogger
+LoggerProto = CliLogger | BasicLogger | JsonLogger
@@ -0,0 +1,100 @@
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+import os
+import threading
+
+import humanize
+
+from lohup.logger import LoggerProto
+
+
+def available_memory() -> int | None:
+    """
+    Returns MemAvailable from /proc/meminfo in bytes.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def go_environ(limit: int | None, gogc: int | None) -> dict[str, str]:
+    """
+    Go runtime settings for engines written in Go (restic).
+    Soft limit is set below the budget, so GC gets more aggressive
+    before the hard cgroup limit kills the process.
+    """
+    env = {}
+    if limit is not None:
+        env["GOMEMLIMIT"] = str(int(limit * 0.9))
+    if gogc is not None:
+        env["GOGC"] = str(gogc)
+    return env
+
+
+def cgroup_wrap(cmd: list[str], limit: int | None) -> list[str]:
+    """
+    Runs command in a transient systemd scope with memory.max set.
+    """
+    if limit is None:
+        return cmd
+    out = ["systemd-run", "--scope", "--quiet", "--collect"]
+    if os.geteuid() != 0:
+        out.append("--user")
+    out.extend(["-p", f"MemoryMax={limit}", "-p", "MemorySwapMax=0", "--"])
+    return out + cmd
+
+
+@dataclass
+class MemoryScheduler:
+    """
+    Admits concurrent jobs while sum of their memory estimates fits
+    the capacity. A job which doesn't fit even alone is started
+    once nothing else runs.
+    """
+
+    capacity: int | None
+    log: LoggerProto
+    reserved: int = field(default=0)
+    running: int = field(default=0)
+    _cond: threading.Condition = field(default_factory=threading.Condition)
+
+    @contextmanager
+    def reserve(self, name: str, estimate: int):
+        with self._cond:
+            waited = False
+            while not self._fits(estimate):
+                if not waited:
+                    self.log.info(
+                        f"Profile {name!r} waits for memory: needs "
+                        f"{humanize.naturalsize(estimate, binary=True)}, "
+                        f"{humanize.naturalsize(self.reserved, binary=True)} reserved"
+                    )
+                    waited = True
+                self._cond.wait()
+            self.reserved += estimate
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved -= estimate
+                self.running -= 1
+                self._cond.notify_all()
+
+    def _fits(self, estimate: int) -> bool:
+        if self.running == 0 or self.capacity is None:
+            return True
+        return self.reserved + estimate <= self.capacity
+
+    @staticmethod
+    def from_conf(settings, log: LoggerProto):
+        capacity = available_memory()
+        if settings.memory_budget is not None:
+            capacity = min(capacity or settings.memory_budget, settings.memory_budget)
+        return MemoryScheduler(capacity=capacity, log=log)
+
@@ -0,0 +1,218 @@
+from collections import deque
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+import os
+import re
+import subprocess as procs
+import threading
+import time
+
+from lohup.util import parse_size
+
+from lohup.logger import LoggerProto
+
+
+# restic: "[0:12] 10.52%  1123 files 1.203 GiB, total 10021 files 11.4 GiB, 0 errors"
+PROGRESS_PATTERN = re.compile(r"^\[\d+(:\d+)+\]\s+\d+(\.\d+)?%|^\s*\d+(\.\d+)?%\s")
+# seconds for an aborted engine to exit before it is killed
+ABORT_TIMEOUT = 30
+
+
+@dataclass
+class Job:
+    """
+    Output of the child processes belonging to one job, like a profile backup.
+    Lines are prefixed with the job name and the last ones are kept
+    to be shown when the job fails.
+    """
+
+    source: str
+    log: LoggerProto
+    tail: int = field(default=50)
+    lines: deque = field(init=False)
+    started: float = field(default_factory=time.monotonic)
+    finished: float | None = field(default=None)
+    # maximal resident set size of the job's processes, in bytes
+    peak_rss: int | None = field(default=None)
+    _threads: list[threading.Thread] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.lines = deque(maxlen=self.tail)
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def attach(self, *streams):
+        for stream in streams:
+            thread = threading.Thread(target=self._pump, args=(stream,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def search(self, pattern: re.Pattern) -> str | None:
+        """
+        Returns first group of the last kept line matching `pattern`.
+        """
+        for line in reversed(self.lines):
+            if match := pattern.search(line):
+                return match.group(1)
+        return None
+
+    def dump(self):
+        if not self.lines:
+            return
+        text = "\n".join(self.lines)
+        self.log.error(f"{self.source}: last {len(self.lines)} lines of output:\n{text}")
+
+    def _pump(self, stream):
+        with stream:
+            for raw in iter(stream.readline, b""):
+                # progress bars redraw the line with carriage returns
+                line = raw.decode(errors="replace").rstrip("\r\n").rsplit("\r", 1)[-1]
+                if not line:
+                    continue
+                self.lines.append(line)
+                if PROGRESS_PATTERN.match(line):
+                    self.log.progress(self.source, line)
+                else:
+                    self.log.output(self.source, line)
+
+
+@dataclass
+class BackupResult:
+    snapshot_id: str | None
+    # bytes stored in the repository
+    added: int | None
+    duration: float
+    peak_rss: int | None = None
+
+    @staticmethod
+    def from_job(job: Job, snapshot: re.Pattern, added: re.Pattern):
+        size = job.search(added)
+        return BackupResult(
+            snapshot_id=job.search(snapshot),
+            added=parse_size(size) if size else None,
+            duration=job.duration,
+            peak_rss=job.peak_rss,
+        )
+
+
+@dataclass
+class Spawner:
+    """
+    Starts child processes with captured stdout/stderr.
+    """
+
+    log: LoggerProto
+    tail: int = field(default=50)
+
+    def job(self, source: str) -> Job:
+        return Job(source, log=self.log, tail=self.tail)
+
+    def check_call(self, cmd: list[str], source: str, env=None):
+        job = self.job(source)
+        proc = procs.Popen(
+            cmd, env=env, stdin=procs.DEVNULL, stdout=procs.PIPE, stderr=procs.PIPE
+        )
+        with self._reaping(job, proc):
+            job.attach(proc.stdout, proc.stderr)
+            self._wait(job, proc)
+        self._verify(job, proc, cmd)
+        return job
+
+    def pipe(self, src_cmd: list[str], cmd: list[str], source: str, env=None):
+        """
+        Streams stdout of `src_cmd` into stdin of `cmd`.
+        """
+        job = self.job(source)
+        proc = procs.Popen(
+            cmd, env=env, stdin=procs.PIPE, stdout=procs.PIPE, stderr=procs.PIPE
+        )
+        with self._reaping(job, proc):
+            job.attach(proc.stdout, proc.stderr)
+            src = procs.Popen(
+                src_cmd, stdin=procs.DEVNULL, stdout=proc.stdin, stderr=procs.PIPE
+            )
+            job.attach(src.stderr)
+            self._wait(job, src)
+            if src.returncode:
+                self._abort(proc)
+            proc.stdin.close()
+            if proc.returncode is None:
+                self._wait(job, proc)
+        self._verify(job, src, src_cmd)
+        self._verify(job, proc, cmd)
+        return job
+
+    def feed(self, chunks, cmd: list[str], source: str, env=None):
+        """
+        Writes byte `chunks` into stdin of `cmd`.
+        """
+        job = self.job(source)
+        proc = procs.Popen(
+            cmd, env=env, stdin=procs.PIPE, stdout=procs.PIPE, stderr=procs.PIPE
+        )
+        with self._reaping(job, proc):
+            job.attach(proc.stdout, proc.stderr)
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+            except BrokenPipeError:
+                # engine exited early, its status tells why
+                pass
+            except BaseException:
+                self._abort(proc)
+                raise
+            with suppress(BrokenPipeError):
+                proc.stdin.close()
+            self._wait(job, proc)
+        self._verify(job, proc, cmd)
+        return job
+
+    @staticmethod
+    def _abort(proc: procs.Popen):
+        """
+        Stops the engine while its stdin is still open, so it doesn't see
+        the end of an incomplete stream and store it as a snapshot.
+        """
+        proc.terminate()
+        try:
+            proc.wait(timeout=ABORT_TIMEOUT)
+        except procs.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    @staticmethod
+    def _wait(job: Job, proc: procs.Popen):
+        # wait4 reports resource usage of exactly this child
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in kilobytes on Linux
+        job.peak_rss = max(job.peak_rss or 0, usage.ru_maxrss * 1024)
+
+    @staticmethod
+    @contextmanager
+    def _reaping(job: Job, proc: procs.Popen):
+        try:
+            yield
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            if proc.stdin is not None:
+                with suppress(OSError):
+                    proc.stdin.close()
+            # pump threads finish at EOF and close the pipes themselves
+            job.join()
+
+    @staticmethod
+    def _verify(job: Job, proc: procs.Popen, cmd: list[str]):
+        job.finished = job.finished or time.monotonic()
+        if proc.returncode:
+            job.dump()
+            raise procs.CalledProcessError(proc.returncode, cmd)
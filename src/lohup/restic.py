@@ -2,25 +2,54 @@ from pathlib import Path
 from dataclasses import dataclass, field
 import os
 import subprocess as procs
-import json
+import re
 
-from lohup import config
+from lohup import config, snapshot
+from lohup.memory import cgroup_wrap, go_environ
+from lohup.fingerprint import StreamFingerprint
+from lohup.output import BackupResult, Spawner
 from lohup.logger import CliLogger, BasicLogger
 
 
+SNAPSHOT_PATTERN = re.compile(r"snapshot ([0-9a-f]+) saved")
+# "Added to the repository: 1.203 GiB (1.100 GiB stored)"
+ADDED_PATTERN = re.compile(r"Added to the repository: .*\(([\d.]+ \w+) stored\)")
+AWS_VARIABLES = ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_DEFAULT_REGION")
+
+
 @dataclass
 class Restic:
     repo: config.Repository
     log: CliLogger | BasicLogger
     binary: str = field(default="restic")
+    cache_dir: Path | None = field(default=None)
+    spawner: Spawner | None = field(default=None)
+    # overrides connections of S3 repository, used for tuned values
+    connections: int | None = field(default=None)
+    # memory budget of backups, enforced by cgroup when `memory_cgroup` is set
+    memory_limit: int | None = field(default=None)
+    memory_cgroup: bool = field(default=False)
+    gogc: int | None = field(default=None)
+
+    def __post_init__(self):
+        if self.spawner is None:
+            self.spawner = Spawner(self.log)
+        if self.connections is None and isinstance(self.repo, config.S3Repository):
+            if isinstance(self.repo.connections, int):
+                self.connections = self.repo.connections
 
     def environ(self):
         env = os.environ.copy()
         env["RESTIC_PASSWORD_FILE"] = self.repo.repo_key_file.value
+        if self.cache_dir is not None:
+            env["RESTIC_CACHE_DIR"] = str(self.cache_dir)
+        env.update(go_environ(self.memory_limit, self.gogc))
         match self.repo:
             case config.S3Repository():
                 if value := self.repo.region:
                     env["AWS_DEFAULT_REGION"] = value
+                if value := self.repo.read_concurrency:
+                    env["RESTIC_READ_CONCURRENCY"] = str(value)
                 if masked := self.repo.access_key_file:
                     env["AWS_ACCESS_KEY_ID"] = Path(masked.value).read_text().strip()
                 if masked := self.repo.secret_key_file:
@@ -34,11 +63,20 @@ class Restic:
                 env["RESTIC_REPOSITORY"] = self.repo.path
         return env
 
-    def run(self, args):
+    def run(self, args, source: str | None = None):
+        """
+        Runs restic with `args`. Output is captured and prefixed with `source`
+        when it is set, otherwise restic writes directly to the terminal.
+        """
         cmd, env = self._prepare(args)
-        procs.check_call(cmd, env=env)
+        if source is None:
+            procs.check_call(cmd, env=env)
+        else:
+            return self.spawner.check_call(cmd, source=source, env=env)
 
-    def backup(self, profile: config.Profile):
+    def backup(
+        self, profile: config.Profile, stream: StreamFingerprint | None = None
+    ):
         args = ["backup", "--tag", profile.name]
         args.extend(profile.cli_args)
         match profile:
@@ -46,37 +84,90 @@ class Restic:
                 for pth in profile.exclude_paths:
                     args.extend(["-e", pth])
                 args.extend(profile.paths)
-                self.run(args)
+                job = self.run(args, source=profile.name)
+            case config.CommandProfile() if stream is not None:
+                args.append("--stdin")
+                job = self.feed_stdin(args, stream, source=profile.name)
             case config.CommandProfile():
                 args.append("--stdin")
                 match profile.command:
                     case str(x):
-                        self.pipe_stdout(args, src_cmd=x.split())
+                        job = self.pipe_stdout(
+                            args, src_cmd=x.split(), source=profile.name
+                        )
                     case list(x):
-                        self.pipe_stdout(args, src_cmd=x)
+                        job = self.pipe_stdout(args, src_cmd=x, source=profile.name)
                     case _:
                         raise NotImplementedError(profile.command)
+        return BackupResult.from_job(job, SNAPSHOT_PATTERN, ADDED_PATTERN)
 
-    def pipe_stdout(self, args: list[str], src_cmd: list[str]):
-        cmd = [self.binary] + args
-        env = self.environ()
-        with procs.Popen(cmd, stdin=procs.PIPE, env=env) as restic:
-            procs.check_call(src_cmd, stdout=restic.stdin)
+    def pipe_stdout(self, args: list[str], src_cmd: list[str], source: str):
+        cmd, env = self._prepare(args)
+        return self.spawner.pipe(src_cmd, cmd, source=source, env=env)
 
-    def snapshots(self, format="text"):
-        cmd, env = self._prepare(["snapshots", "--compact"])
+    def feed_stdin(self, args: list[str], stream: StreamFingerprint, source: str):
+        """
+        Feeds spooled and remaining output of `stream` into stdin of restic.
+        """
+        cmd, env = self._prepare(args)
+        return self.spawner.feed(stream.chunks(), cmd, source=source, env=env)
+
+    def snapshots(
+        self,
+        format="text",
+        tags: tuple[str, ...] = (),
+        host: str | None = None,
+        latest: int | None = None,
+    ):
+        args = ["snapshots", "--compact"]
+        for tag in tags:
+            args.extend(["--tag", tag])
+        if host is not None:
+            args.extend(["--host", host])
+        if latest is not None:
+            args.extend(["--latest", str(latest)])
+        cmd, env = self._prepare(args)
         if format == "json":
             cmd.append("--json")
         result = procs.check_output(cmd, env=env, encoding="utf-8")
         if format == "json":
-            return json.loads(result)
+            return snapshot.parse_restic(result)
         return result
 
+    def copy_from(self, other: "Restic", ids: list[str], source: str):
+        """
+        Copies snapshots `ids` from repository of `other` into this one.
+        restic has no separate AWS settings for the source repository,
+        so S3 source and target must use the same credentials and region.
+        """
+        cmd, env = self._prepare(["copy", *ids])
+        src_env = other.environ()
+        env["RESTIC_FROM_REPOSITORY"] = src_env["RESTIC_REPOSITORY"]
+        env["RESTIC_FROM_PASSWORD_FILE"] = src_env["RESTIC_PASSWORD_FILE"]
+        if isinstance(other.repo, config.S3Repository):
+            if isinstance(self.repo, config.S3Repository):
+                if any(env.get(x) != src_env.get(x) for x in AWS_VARIABLES):
+                    raise ValueError(
+                        f"Can't copy from {other.repo.name!r} to {self.repo.name!r}:"
+                        " restic uses one set of AWS credentials and region"
+                        " for both S3 repositories"
+                    )
+            else:
+                for name in AWS_VARIABLES:
+                    env.pop(name, None)
+                    if name in src_env:
+                        env[name] = src_env[name]
+        self.spawner.check_call(cmd, source=source, env=env)
+
     def _prepare(self, args: list[str]):
         if self.repo is None:
             raise ValueError("repo not set")
         cmd = [self.binary]
+        if self.connections is not None:
+            cmd.extend(["-o", f"s3.connections={self.connections}"])
         cmd.extend(args)
+        if self.memory_cgroup:
+            cmd = cgroup_wrap(cmd, self.memory_limit)
         env = self.environ()
         return cmd, env
 
@@ -84,4 +175,4 @@ class Restic:
         return self
 
     def __exit__(self, type, value, traceback):
-        return self
+        return False
@@ -1,28 +1,60 @@
 from pathlib import Path
 from dataclasses import dataclass, field
 import subprocess as procs
-import json
+import re
+import uuid
 import tomlkit
 
-from lohup import config
+from lohup import config, snapshot
+from lohup.memory import cgroup_wrap
+from lohup.fingerprint import StreamFingerprint
+from lohup.output import BackupResult, Spawner
 from lohup.logger import LoggerProto
 
 
+SNAPSHOT_PATTERN = re.compile(r"snapshot ([0-9a-f]+) successfully saved")
+# "Added to the repo: 1.2 GiB (raw: 1.5 GiB)"
+ADDED_PATTERN = re.compile(r"Added to the repo: ([\d.]+ \w+)")
+
+
 @dataclass
 class Rustic:
     repo: config.Repository
     log: LoggerProto
     conf_dir: Path
     binary: str = field(default="rustic")
+    cache_dir: Path | None = field(default=None)
+    spawner: Spawner | None = field(default=None)
+    # overrides connections of S3 repository, used for tuned values
+    connections: int | None = field(default=None)
+    # memory budget of backups, enforced by cgroup when `memory_cgroup` is set
+    memory_limit: int | None = field(default=None)
+    memory_cgroup: bool = field(default=False)
+
+    def __post_init__(self):
+        self._token = uuid.uuid4().hex[:8]
+        if self.spawner is None:
+            self.spawner = Spawner(self.log)
+        if self.connections is None and isinstance(self.repo, config.S3Repository):
+            if isinstance(self.repo.connections, int):
+                self.connections = self.repo.connections
+
+    @property
+    def profile(self) -> Path:
+        # every engine gets own config, so engines may run concurrently
+        return self.conf_dir / f"rustic-{self.repo.name}-{self._token}"
 
     @property
     def conf_file(self) -> Path:
-        return self.conf_dir / "rustic.toml"
+        return self.conf_dir / f"rustic-{self.repo.name}-{self._token}.toml"
 
-    def write_config(self) -> Path:
+    def write_config(self, conf_file: Path | None = None, copy_targets=()) -> Path:
+        conf_file = conf_file or self.conf_file
         out = {}
         repo_pass = Path(self.repo.repo_key_file.value).read_text().strip()
         out["repository"] = {"password": repo_pass}
+        if self.cache_dir is not None:
+            out["repository"]["cache-dir"] = str(self.cache_dir)
         match self.repo:
             case config.S3Repository():
                 out["repository"]["repository"] = "opendal:s3"
@@ -35,23 +67,37 @@ class Rustic:
                 opts["bucket"] = self.repo.bucket
                 opts["root"] = self.repo.path
                 opts["region"] = self.repo.region
+                if self.connections is not None:
+                    opts["connections"] = str(self.connections)
+                # rustic has no read concurrency setting, so it is not passed
                 out["repository"]["options"] = opts
             case config.LocalRepository():
                 out["repository"]["repository"] = self.repo.path
-        self.conf_dir.mkdir(exist_ok=True)
-        with self.conf_file.open("w") as f:
+        if copy_targets:
+            out["copy"] = {"targets": [str(x) for x in copy_targets]}
+        self.conf_dir.mkdir(parents=True, exist_ok=True)
+        with conf_file.open("w") as f:
             tomlkit.dump(out, f)
+        return conf_file
 
-    def _cmdline(self):
-        out = [self.binary, "--log-level=warn", "-P", str(self.conf_dir / "rustic")]
+    def _cmdline(self, profile: Path | None = None):
+        out = [self.binary, "--log-level=warn", "-P", str(profile or self.profile)]
+        if self.memory_cgroup:
+            # rustic has no runtime memory limit, only the cgroup one applies
+            out = cgroup_wrap(out, self.memory_limit)
         return out
 
-    def run(self, args):
+    def run(self, args, source: str | None = None):
         cmd = self._cmdline()
         cmd.extend(args)
-        procs.check_call(cmd)
+        if source is None:
+            procs.check_call(cmd)
+        else:
+            return self.spawner.check_call(cmd, source=source)
 
-    def backup(self, profile: config.Profile):
+    def backup(
+        self, profile: config.Profile, stream: StreamFingerprint | None = None
+    ):
         args = ["backup", "--tag", profile.name]
         args.extend(profile.cli_args)
         match profile:
@@ -59,30 +105,84 @@ class Rustic:
                 for pth in profile.exclude_paths:
                     args.extend(["--glob", f"!{pth}"])
                 args.extend(profile.paths)
-                self.run(args)
+                job = self.run(args, source=profile.name)
+            case config.CommandProfile() if stream is not None:
+                args.append("-")
+                job = self.feed_stdin(args, stream, source=profile.name)
             case config.CommandProfile():
                 args.append("-")
                 match profile.command:
                     case str(x):
-                        self.pipe_stdout(args, src_cmd=x.split())
+                        job = self.pipe_stdout(
+                            args, src_cmd=x.split(), source=profile.name
+                        )
                     case list(x):
-                        self.pipe_stdout(args, src_cmd=x)
+                        job = self.pipe_stdout(args, src_cmd=x, source=profile.name)
+                    case _:
+                        raise NotImplementedError(profile.command)
+        return BackupResult.from_job(job, SNAPSHOT_PATTERN, ADDED_PATTERN)
 
-    def pipe_stdout(self, args: list[str], src_cmd: list[str]):
+    def pipe_stdout(self, args: list[str], src_cmd: list[str], source: str):
         cmd = self._cmdline()
         cmd.extend(args)
-        with procs.Popen(cmd, stdin=procs.PIPE) as rustic:
-            procs.check_call(src_cmd, stdout=rustic.stdin)
+        return self.spawner.pipe(src_cmd, cmd, source=source)
 
-    def snapshots(self, format="text"):
+    def feed_stdin(self, args: list[str], stream: StreamFingerprint, source: str):
+        cmd = self._cmdline()
+        cmd.extend(args)
+        return self.spawner.feed(stream.chunks(), cmd, source=source)
+
+    def snapshots(
+        self,
+        format="text",
+        tags: tuple[str, ...] = (),
+        host: str | None = None,
+        latest: int | None = None,
+    ):
+        if latest is not None and format != "json":
+            # rustic has no --latest, it is applied to parsed snapshots only
+            raise ValueError("rustic supports latest only with json format")
         cmd = self._cmdline()
         cmd.extend(["snapshots", "--compact"])
+        for tag in tags:
+            cmd.extend(["--filter-tags", tag])
+        if host is not None:
+            cmd.extend(["--filter-host", host])
         if format == "json":
             cmd.append("--json")
         result = procs.check_output(cmd, encoding="utf-8")
-        if format == "json":
-            return json.loads(result)
-        return result
+        if format != "json":
+            return result
+        snaps = snapshot.parse_rustic(result)
+        if not latest:
+            return snaps
+        # rustic has no --latest, so it is applied per host and paths like restic
+        groups: dict[tuple, list] = {}
+        for snap in snaps:
+            groups.setdefault((snap.hostname, snap.paths), []).append(snap)
+        out = []
+        for group in groups.values():
+            group.sort(key=lambda x: x.time)
+            out.extend(group[-latest:])
+        return out
+
+    def copy_from(self, other: "Rustic", ids: list[str], source: str):
+        """
+        Copies snapshots `ids` from repository of `other` into this one.
+        Target profile of this engine must be written already.
+        """
+        # rustic reads copy targets from the source profile, so every call
+        # gets a profile of its own and concurrent copies don't interfere
+        profile = self.conf_dir / f"rustic-copy-{other.repo.name}-{uuid.uuid4().hex}"
+        conf_file = other.write_config(
+            profile.parent / f"{profile.name}.toml", copy_targets=[self.profile]
+        )
+        try:
+            cmd = self._cmdline(profile)
+            cmd.extend(["copy", *ids])
+            self.spawner.check_call(cmd, source=source)
+        finally:
+            conf_file.unlink(True)
 
     def __enter__(self):
         self.write_config()
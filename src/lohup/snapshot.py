@@ -0,0 +1,109 @@
+from datetime import datetime
+import json
+import sys
+
+
+class Summary:
+    """
+    Statistics of the backup which produced a snapshot.
+    """
+
+    __slots__ = (
+        "files_new",
+        "files_changed",
+        "total_files",
+        "data_added",
+        "data_added_packed",
+        "total_bytes",
+        "_backup_end",
+    )
+
+    def __init__(self, raw: dict):
+        self.files_new: int = raw.get("files_new", 0)
+        self.files_changed: int = raw.get("files_changed", 0)
+        self.total_files: int = raw.get("total_files_processed", 0)
+        self.data_added: int = raw.get("data_added", 0)
+        self.data_added_packed: int = raw.get("data_added_packed", 0)
+        self.total_bytes: int = raw.get("total_bytes_processed", 0)
+        self._backup_end: str | datetime | None = raw.get("backup_end")
+
+    @property
+    def backup_end(self) -> datetime | None:
+        if isinstance(self._backup_end, str):
+            self._backup_end = datetime.fromisoformat(self._backup_end)
+        return self._backup_end
+
+    @property
+    def changes(self) -> int:
+        return self.files_new + self.files_changed
+
+
+class Snapshot:
+    """
+    Snapshot of either engine, keeping only the fields lohup uses.
+    Timestamps are parsed on first access, repeated strings are interned.
+    """
+
+    __slots__ = (
+        "id",
+        "original",
+        "hostname",
+        "tags",
+        "paths",
+        "summary",
+        "repo",
+        "_time",
+    )
+
+    def __init__(self, raw: dict):
+        self.id: str = raw["id"]
+        self.original: str | None = raw.get("original")
+        self.hostname: str = sys.intern(raw.get("hostname", ""))
+        self.tags: tuple[str, ...] = tuple(sys.intern(x) for x in raw.get("tags") or ())
+        self.paths: tuple[str, ...] = tuple(raw.get("paths") or ())
+        summary = raw.get("summary")
+        self.summary: Summary | None = summary if isinstance(summary, Summary) else None
+        self.repo: str | None = None
+        self._time: str | datetime = raw["time"]
+
+    @property
+    def short_id(self) -> str:
+        return self.id[:8]
+
+    @property
+    def time(self) -> datetime:
+        if isinstance(self._time, str):
+            self._time = datetime.fromisoformat(self._time)
+        return self._time
+
+    @property
+    def name(self) -> str:
+        return "-".join(self.tags)
+
+    def __repr__(self):
+        return f"Snapshot({self.short_id}, tags={self.tags}, repo={self.repo})"
+
+
+def _object_hook(raw: dict):
+    # json calls the hook for inner objects first, so summaries are
+    # converted before snapshots and raw dicts are dropped right away
+    if "time" in raw and "tree" in raw:
+        return Snapshot(raw)
+    if "total_files_processed" in raw:
+        return Summary(raw)
+    return raw
+
+
+def parse_restic(text: str) -> list[Snapshot]:
+    return json.loads(text, object_hook=_object_hook)
+
+
+def parse_rustic(text: str) -> list[Snapshot]:
+    """
+    Flattens rustic output, grouped by host, label and paths:
+    [[group, [snapshot...]]...]
+    """
+    out = []
+    for _, snaps in json.loads(text, object_hook=_object_hook):
+        out.extend(snaps)
+    return out
@@ -0,0 +1,65 @@
+from dataclasses import dataclass, field
+
+from lohup.history import History
+from lohup.logger import LoggerProto
+from lohup.output import BackupResult
+
+
+@dataclass
+class ConnectionTuner:
+    """
+    Adjusts connection count of S3 repositories with connections = "auto".
+    Backups of one run uploading enough data are a sample of throughput
+    for the connection count they used. Samples are averaged per count;
+    the count moves by `step` while it is faster than the count it moved
+    from, and turns back when it is slower.
+    """
+
+    history: History
+    log: LoggerProto
+    initial: int = field(default=5)
+    step: int = field(default=2)
+    minimum: int = field(default=1)
+    maximum: int = field(default=64)
+    min_sample: int = field(default=64 * 1024**2)
+    keep_samples: int = field(default=20)
+
+    def current(self, repo: str) -> int:
+        return self.history.repo(repo).get("connections", self.initial)
+
+    def record(self, repo: str, connections: int, results: list[BackupResult]):
+        """
+        Records throughput of all backups of one run into `repo`.
+        """
+        measured = [x for x in results if x.added and x.duration]
+        added = sum(x.added for x in measured)
+        duration = sum(x.duration for x in measured)
+        if added < self.min_sample:
+            return
+        state = self.history.repo(repo)
+        rate = added / duration
+        samples = state.get("samples", []) + [
+            {"connections": connections, "rate": rate}
+        ]
+        samples = samples[-self.keep_samples :]
+        rates = self._mean_rates(samples)
+        direction = state.get("direction", 1)
+        previous = connections - direction * self.step
+        if previous in rates and rates[connections] < rates[previous]:
+            direction = -direction
+        value = min(max(connections + direction * self.step, self.minimum), self.maximum)
+        self.history.update_repo(
+            repo, connections=value, direction=direction, samples=samples
+        )
+        self.history.save()
+        self.log.info(
+            f"Repo {repo!r}: {rate / 1024**2:.1f} MiB/s with {connections} "
+            f"connections, next run will use {value}"
+        )
+
+    @staticmethod
+    def _mean_rates(samples: list[dict]) -> dict[int, float]:
+        groups: dict[int, list[float]] = {}
+        for sample in samples:
+            groups.setdefault(sample["connections"], []).append(sample["rate"])
+        return {count: sum(x) / len(x) for count, x in groups.items()}
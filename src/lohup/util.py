@@ -98,3 +98,35 @@ def ensure_exists(name, expect="file", field=None) -> str | None:
     if msg is not None and field is not None:
         return f"field {field!r}: {msg}"
     return msg
+
+
+SIZE_UNITS = {
+    "": 1,
+    "b": 1,
+    "k": 1000,
+    "kb": 1000,
+    "kib": 1024,
+    "m": 1000**2,
+    "mb": 1000**2,
+    "mib": 1024**2,
+    "g": 1000**3,
+    "gb": 1000**3,
+    "gib": 1024**3,
+    "t": 1000**4,
+    "tb": 1000**4,
+    "tib": 1024**4,
+}
+
+
+def parse_size(value: int | str) -> int:
+    """
+    Parses size like 512, "100M" or "1.5GiB" into bytes.
+    """
+    if isinstance(value, int):
+        return value
+    text = value.strip().lower()
+    number = text.rstrip("abcdefghijklmnopqrstuvwxyz ")
+    unit = text[len(number) :].strip()
+    if unit not in SIZE_UNITS or not number:
+        raise ValueError(f"invalid size: {value!r}")
+    return int(float(number) * SIZE_UNITS[unit])
@@ -0,0 +1,252 @@
+from pathlib import Path
+from dataclasses import dataclass, field
+import ctypes
+import errno
+import fnmatch
+import math
+import os
+import select
+import struct
+import time
+
+from lohup import config
+from lohup.logger import LoggerProto
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+)
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Minimal inotify binding, events are read as (wd, mask, name) tuples.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self) -> list[tuple[int, int, str]]:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+@dataclass
+class ChangeTrigger:
+    """
+    Accumulates changes of one profile and decides when its backup is due.
+    Bursts of changes are coalesced: backup waits for `debounce` seconds
+    of quiet once thresholds are reached, but no longer than `max_delay`
+    since the first change, and never sooner than `min_interval`
+    after the previous backup.
+    """
+
+    spec: config.WatchSpec
+    changes: int = field(default=0)
+    size: int = field(default=0)
+    first: float | None = field(default=None)
+    last: float | None = field(default=None)
+    last_backup: float = field(default=-math.inf)
+
+    def record(self, now: float, size: int = 0):
+        self.changes += 1
+        self.size += size
+        if self.first is None:
+            self.first = now
+        self.last = now
+
+    def due(self, now: float) -> bool:
+        if not self.changes:
+            return False
+        if now - self.last_backup < self.spec.min_interval:
+            return False
+        if now - self.first >= self.spec.max_delay:
+            return True
+        reached = self.changes >= self.spec.changes or (
+            self.spec.bytes is not None and self.size >= self.spec.bytes
+        )
+        return reached and now - self.last >= self.spec.debounce
+
+    def reset(self, now: float):
+        self.changes = 0
+        self.size = 0
+        self.first = self.last = None
+        self.last_backup = now
+
+    def failed(self, now: float):
+        """
+        Keeps changes of a failed backup, it is retried after `min_interval`.
+        """
+        self.last_backup = now
+
+
+@dataclass
+class Watcher:
+    """
+    Watches paths of profiles recursively and calls `backup(profile_name)`
+    when the profile's trigger becomes due.
+    """
+
+    profiles: list[config.PathsProfile]
+    backup: object
+    log: LoggerProto
+    poll_interval: float = field(default=1.0)
+    triggers: dict[str, ChangeTrigger] = field(default_factory=dict)
+    # watch descriptor -> [(profile, directory)], profiles may overlap
+    _watches: dict[int, list[tuple[config.PathsProfile, Path]]] = field(
+        default_factory=dict
+    )
+    _inotify: Inotify | None = field(default=None)
+
+    def run(self):
+        self._inotify = Inotify()
+        try:
+            for profile in self.profiles:
+                self.triggers[profile.name] = ChangeTrigger(profile.watch)
+                self._watch_profile(profile)
+            self.log.info(f"Watching {len(self._watches)} directories")
+            while True:
+                self.step()
+        finally:
+            self._inotify.close()
+
+    def step(self):
+        ready, _, _ = select.select([self._inotify.fd], [], [], self.poll_interval)
+        now = time.monotonic()
+        if ready:
+            for wd, mask, name in self._inotify.read():
+                self._handle(now, wd, mask, name)
+        for name, trigger in self.triggers.items():
+            if trigger.due(now):
+                self.log.info(
+                    f"Profile {name!r}: {trigger.changes} changes, "
+                    f"{trigger.size} bytes, starting backup"
+                )
+                try:
+                    self.backup(name)
+                except Exception as e:
+                    self.log.error(e)
+                    trigger.failed(now)
+                    continue
+                # changes made during the backup are counted for the next one
+                trigger.reset(now)
+
+    def _handle(self, now: float, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self.log.warning("inotify queue overflowed, marking all profiles changed")
+            for trigger in self.triggers.values():
+                trigger.record(now)
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        for profile, directory in self._watches.get(wd, []):
+            path = directory / name
+            if name and self._excluded(profile, path):
+                continue
+            size = 0
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(profile, path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                try:
+                    size = path.stat().st_size
+                except FileNotFoundError:
+                    pass
+            self.triggers[profile.name].record(now, size)
+
+    def _watch_profile(self, profile: config.PathsProfile):
+        count = 0
+        for path in profile.paths:
+            if not Path(path).is_dir():
+                raise ValueError(
+                    f"Profile {profile.name!r}: {path} is not an existing "
+                    "directory, set watch paths to directories to watch"
+                )
+            count += self._watch_tree(profile, Path(path))
+        if not count:
+            raise ValueError(f"Profile {profile.name!r}: no directories to watch")
+
+    def _watch_tree(self, profile: config.PathsProfile, root: Path) -> int:
+        """
+        Watches directories under `root`, returns how many were added.
+        """
+        count = 0
+        for directory, dirs, _ in os.walk(root):
+            current = Path(directory)
+            if self._excluded(profile, current):
+                dirs.clear()
+                continue
+            try:
+                wd = self._inotify.add_watch(directory)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self.log.warning(
+                        "inotify watch limit reached, "
+                        "raise fs.inotify.max_user_watches"
+                    )
+                    return count
+                continue
+            entries = self._watches.setdefault(wd, [])
+            if (profile, current) not in entries:
+                entries.append((profile, current))
+            count += 1
+        return count
+
+    @staticmethod
+    def _excluded(profile: config.PathsProfile, path: Path) -> bool:
+        # patterns without slash match any path component, like restic does
+        for pattern in profile.exclude_paths:
+            if "/" in pattern:
+                if fnmatch.fnmatch(str(path), pattern):
+                    return True
+            elif fnmatch.fnmatch(path.name, pattern):
+                return True
+        return False
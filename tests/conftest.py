@@ -0,0 +1,156 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+import os
+
+import pytest
+
+from lohup import config
+from lohup.app import Lohup
+from lohup.logger import BasicLogger, LogLevel
+from lohup.snapshot import Snapshot
+
+
+FAKE_RESTIC = """#!/bin/sh
+echo "restic $*" >> "$FAKE_DIR/calls"
+if [ "$1" = backup ]; then
+    if [ -e "$FAKE_DIR/fail-$3" ]; then
+        echo "failing $3" >&2
+        exit 1
+    fi
+    case " $* " in
+        *" --stdin "*) cat > "$FAKE_DIR/stdin-$3" ;;
+    esac
+    if [ -e "$FAKE_DIR/slow" ]; then
+        sleep 0.3
+    fi
+    printf "snapshot %08x saved\\n" "$(wc -l < "$FAKE_DIR/calls")"
+fi
+"""
+
+FAKE_BTRFS = """#!/bin/sh
+echo "btrfs $*" >> "$FAKE_DIR/calls"
+if [ "$2" = snapshot ]; then
+    mkdir -p "$4"
+elif [ "$2" = delete ]; then
+    rm -rf "$3"
+fi
+"""
+
+FAKE_HOOK = """#!/bin/sh
+echo "hook $*" >> "$FAKE_DIR/calls"
+"""
+
+
+@dataclass
+class FakeBin:
+    """
+    Fake restic, btrfs and hook command on PATH, recording their calls.
+    """
+
+    root: Path
+
+    def calls(self, prefix: str = "") -> list[str]:
+        path = self.root / "calls"
+        lines = path.read_text().splitlines() if path.exists() else []
+        return [x for x in lines if x.startswith(prefix)]
+
+    def fail(self, profile: str, enabled: bool = True):
+        path = self.root / f"fail-{profile}"
+        if enabled:
+            path.touch()
+        else:
+            path.unlink(True)
+
+    def slow(self):
+        (self.root / "slow").touch()
+
+    def reset(self):
+        (self.root / "calls").unlink(True)
+
+
+@pytest.fixture
+def fake_bin(tmp_path, monkeypatch):
+    root = tmp_path / "fake"
+    bindir = root / "bin"
+    bindir.mkdir(parents=True)
+    for name, text in (
+        ("restic", FAKE_RESTIC),
+        ("btrfs", FAKE_BTRFS),
+        ("record-hook", FAKE_HOOK),
+    ):
+        path = bindir / name
+        path.write_text(text)
+        path.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_DIR", str(root))
+    return FakeBin(root)
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """
+    Writes config (formatted with `base` and `pwfile`) and loads the app.
+    """
+    pwfile = tmp_path / "password.txt"
+    pwfile.write_text("1")
+
+    def make(toml: str) -> Lohup:
+        path = tmp_path / "lohup.toml"
+        path.write_text(toml.format(base=tmp_path, pwfile=pwfile))
+        app = Lohup(config_path=path, logger=BasicLogger(level=LogLevel.ERROR))
+        app.load()
+        return app
+
+    return make
+
+
+@dataclass
+class StubEngine:
+    """
+    Engine serving a fixed snapshot list and recording copies.
+    """
+
+    name: str
+    snaps: list[Snapshot] = field(default_factory=list)
+    copies: list[tuple[str, list[str]]] = field(default_factory=list)
+    error: Exception | None = None
+
+    def snapshots(self, format="text", tags=(), host=None, latest=None):
+        if self.error is not None:
+            raise self.error
+        if format != "json":
+            return f"{len(self.snaps)} snapshots\n"
+        return [x for x in self.snaps if not tags or set(tags) & set(x.tags)]
+
+    def copy_from(self, other: "StubEngine", ids: list[str], source: str):
+        self.copies.append((other.name, sorted(ids)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+class StubEngines(dict):
+    """
+    Stub engines by repo name, created on first access.
+    """
+
+    def __missing__(self, name: str) -> StubEngine:
+        engine = self[name] = StubEngine(name)
+        return engine
+
+
+@pytest.fixture
+def stub_engines(monkeypatch) -> StubEngines:
+    """
+    Replaces engines of the app with StubEngine instances, one per repo.
+    """
+    engines = StubEngines()
+
+    def engine_for(app, repo: config.Repository, profile=None):
+        return engines[repo.name]
+
+    monkeypatch.setattr(Lohup, "_engine_for", engine_for)
+    return engines
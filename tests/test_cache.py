@@ -0,0 +1,52 @@
+import os
+
+from lohup.cache import CacheManager, MARKER
+from lohup.config import LocalRepository
+from lohup.logger import BasicLogger, LogLevel
+from lohup.util import Masked, parse_size
+
+
+def repo(name):
+    return LocalRepository(name, path="/", repo_key_file=Masked(""), default=False)
+
+
+def test_parse_size():
+    assert parse_size(10) == 10
+    assert parse_size("100M") == 100 * 1000**2
+    assert parse_size("1.5 GiB") == int(1.5 * 1024**3)
+
+
+def test_lru_eviction(tmp_path):
+    cache = CacheManager(tmp_path, budget=150, log=BasicLogger(level=LogLevel.DEBUG))
+    for age, name in enumerate(["old", "recent", "current"]):
+        path = cache.dir_for(repo(name))
+        path.joinpath("data").write_bytes(b"x" * 100)
+        os.utime(path / MARKER, (age, age))
+    cache.enforce(keep={"current"})
+    assert sorted(x.name for x in cache.caches()) == ["current"]
+
+
+class RecordingLogger(BasicLogger):
+    def __init__(self):
+        super().__init__(level=LogLevel.DEBUG)
+        self.records = []
+
+    def info(self, msg):
+        self.records.append(msg)
+
+
+def test_concurrent_reports(tmp_path):
+    log = RecordingLogger()
+    cache = CacheManager(tmp_path, budget=None, log=log)
+    path = cache.dir_for(repo("cloud"))
+    path.joinpath("index").write_bytes(b"x" * 300)
+    first = cache.start(repo("cloud"))
+    path.joinpath("pack-1").write_bytes(b"x" * 100)
+    second = cache.start(repo("cloud"))
+    path.joinpath("pack-2").write_bytes(b"x" * 200)
+    cache.report(repo("cloud"), before=second)
+    cache.report(repo("cloud"), before=first)
+    assert log.records == [
+        "Cache of repo 'cloud': 600 Bytes, fetched 200 Bytes, reused 66.7%",
+        "Cache of repo 'cloud': 600 Bytes, fetched 300 Bytes, reused 50.0%",
+    ]
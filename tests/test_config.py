@@ -0,0 +1,160 @@
+from lohup.app import Lohup
+from lohup.config import ConfigError
+from lohup.logger import BasicLogger, LogLevel
+
+import pytest
+
+main_toml = """
+include = ["conf.d/*.toml"]
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[profiles.db-main]
+paths = ["/var/lib/main"]
+tags = ["db"]
+"""
+
+included_toml = """
+[repos.cloud]
+kind = "local"
+path = "{base}/cloud"
+repo-key-file = "{pwfile}"
+
+[profiles.db-users]
+paths = ["/var/lib/users"]
+repo = "cloud"
+tags = ["db"]
+
+[profiles.documents]
+paths = ["/home/user/Documents"]
+repo = "cloud"
+
+[[hooks.before-all]]
+kind = "command"
+command = "true"
+"""
+
+
+def load(tmp_path, **files):
+    pwfile = tmp_path / "password.txt"
+    pwfile.write_text("1")
+    for name, text in files.items():
+        path = tmp_path / name.replace("__", "/")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text.format(base=tmp_path, pwfile=pwfile))
+    app = Lohup(
+        config_path=tmp_path / "lohup.toml", logger=BasicLogger(level=LogLevel.DEBUG)
+    )
+    app.load()
+    return app
+
+
+def test_include_and_index(tmp_path):
+    app = load(tmp_path, **{"lohup.toml": main_toml, "conf.d__a.toml": included_toml})
+    conf = app.config
+    assert list(conf.profiles) == ["db-main", "db-users", "documents"]
+    assert conf.default_repo is conf.repos["local"]
+    assert conf.profile_repos["db-main"] is conf.repos["local"]
+    assert conf.profile_repos["db-users"] is conf.repos["cloud"]
+    assert [x.name for x in conf.tagged["db"]] == ["db-main", "db-users"]
+    assert len(conf.hooks.before_all) == 1
+
+
+def test_select(tmp_path):
+    app = load(tmp_path, **{"lohup.toml": main_toml, "conf.d__a.toml": included_toml})
+    names = lambda profiles: [x.name for x in profiles]  # noqa: E731
+    assert names(app.config.select(patterns=("db-*",))) == ["db-main", "db-users"]
+    assert names(app.config.select(patterns=("db-*",), repo="cloud")) == ["db-users"]
+    assert names(app.config.select(repo="cloud")) == ["db-users", "documents"]
+    assert names(app.config.select(tags=("db",), repo="local")) == ["db-main"]
+    with pytest.raises(KeyError):
+        app.config.select(repo="unknown")
+
+
+def test_include_redefinition(tmp_path):
+    included = "[profiles.db-main]\npaths = ['/tmp']\n"
+    with pytest.raises(ConfigError) as exc:
+        load(tmp_path, **{"lohup.toml": main_toml, "conf.d__a.toml": included})
+    assert "profile 'db-main' is already defined" in str(exc.value.__cause__)
+
+
+template_toml = """
+[settings.globalvars]
+ROOT = "{base}"
+HOMES = "$ROOT/home"
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[profiles."home-$USER"]
+paths = ["$USER_PATH/Documents"]
+exclude-paths = ["$CACHE"]
+tags = ["home", "$USER"]
+vars = {{ CACHE = "$USER_PATH/.cache" }}
+for-each = {{ var = "USER", glob = "$HOMES/*" }}
+
+[profiles."db-${{ITEM}}_dump"]
+command = "pg_dump $ITEM"
+for-each = {{ list = ["main", "users"] }}
+"""
+
+
+def test_templates(tmp_path):
+    for user in ("alice", "bob"):
+        (tmp_path / "home" / user).mkdir(parents=True)
+    app = load(tmp_path, **{"lohup.toml": template_toml})
+    profiles = app.config.profiles
+    assert list(profiles) == ["home-alice", "home-bob", "db-main_dump", "db-users_dump"]
+    alice = profiles["home-alice"]
+    assert alice.paths == [f"{tmp_path}/home/alice/Documents"]
+    assert alice.exclude_paths == [f"{tmp_path}/home/alice/.cache"]
+    assert alice.tags == ["home", "alice"]
+    assert profiles["db-users_dump"].command == "pg_dump users"
+    assert [x.name for x in app.config.tagged["bob"]] == ["home-bob"]
+
+
+def test_circular_globals(tmp_path):
+    toml = main_toml + '[settings.globalvars]\nA = "$B"\nB = "x$A"\n'
+    with pytest.raises(ConfigError) as exc:
+        load(tmp_path, **{"lohup.toml": toml})
+    assert "circular reference A -> B -> A" in str(exc.value.__cause__)
+
+
+def test_command_keeps_shell_variables(tmp_path):
+    toml = main_toml + (
+        "[profiles.home-tar]\n"
+        'command = ["sh", "-c", "tar cf - $HOME ${{XDG_DATA_HOME}} {base}"]\n'
+        "\n[profiles.env]\n"
+        'command = "printenv $SHELL"\n'
+    )
+    app = load(tmp_path, **{"lohup.toml": toml})
+    profiles = app.config.profiles
+    expected = ["sh", "-c", f"tar cf - $HOME ${{XDG_DATA_HOME}} {tmp_path}"]
+    assert profiles["home-tar"].command == expected
+    assert profiles["env"].command == "printenv $SHELL"
+
+
+def test_include_settings(tmp_path):
+    main = main_toml.replace(
+        'include = ["conf.d/*.toml"]',
+        'include = ["conf.d/*.toml"]\n\n[settings]\ntmp-dir = "{base}/main"\n',
+    )
+    included = '[settings]\ntmp-dir = "{base}/included"\njobs = 2\n'
+    app = load(tmp_path, **{"lohup.toml": main, "conf.d__a.toml": included})
+    # the including file wins, values it doesn't set are taken
+    assert app.config.settings.build_dir == tmp_path / "main"
+    assert app.config.settings.jobs == 2
+    other = "[settings]\njobs = 3\n"
+    with pytest.raises(ConfigError) as exc:
+        load(
+            tmp_path,
+            **{"lohup.toml": main, "conf.d__a.toml": included, "conf.d__b.toml": other},
+        )
+    assert "'jobs' is already set by another include" in str(exc.value.__cause__)
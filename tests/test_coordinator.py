@@ -0,0 +1,53 @@
+import threading
+import time
+
+from lohup.coordinator import Coordinator
+from lohup.logger import BasicLogger, LogLevel
+
+
+def test_coalescing(tmp_path):
+    coordinator = Coordinator(tmp_path, log=BasicLogger(level=LogLevel.DEBUG))
+    claimed = threading.Event()
+    results = {}
+
+    def first():
+        with coordinator.claim(["db"]) as claim:
+            claimed.set()
+            time.sleep(0.3)
+            claim.record("db", "abcdef")
+
+    def second():
+        claimed.wait()
+        with coordinator.claim(["db", "docs"]) as claim:
+            results["names"] = claim.names
+            results["coalesced"] = claim.coalesced
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"names": ["docs"], "coalesced": {"db": "abcdef"}}
+
+
+def test_failed_run_is_repeated(tmp_path):
+    coordinator = Coordinator(tmp_path, log=BasicLogger(level=LogLevel.DEBUG))
+    claimed = threading.Event()
+    results = {}
+
+    def first():
+        with coordinator.claim(["db"]):
+            claimed.set()
+            time.sleep(0.2)
+
+    def second():
+        claimed.wait()
+        with coordinator.claim(["db"]) as claim:
+            results["names"] = claim.names
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"names": ["db"]}
@@ -0,0 +1,83 @@
+import hashlib
+import sys
+
+from lohup.fingerprint import StreamFingerprint
+from lohup.logger import BasicLogger, LogLevel
+from lohup.output import Spawner
+
+
+def stream(tmp_path, code, limit):
+    spawner = Spawner(BasicLogger(level=LogLevel.ERROR))
+    cmd = [sys.executable, "-c", code]
+    return StreamFingerprint(
+        cmd, job=spawner.job("cmd"), spool_dir=tmp_path, limit=limit
+    )
+
+
+def test_spooled_output(tmp_path):
+    code = "print('payload')"
+    with stream(tmp_path, code, limit=1024) as fp:
+        assert fp.fill()
+        assert fp.digest == hashlib.sha256(b"payload\n").hexdigest()
+        assert b"".join(fp.chunks()) == b"payload\n"
+
+
+def test_output_over_limit(tmp_path):
+    code = "import sys\nsys.stdout.write('x' * 300000)"
+    with stream(tmp_path, code, limit=1000) as fp:
+        assert not fp.fill()
+        assert fp.digest is None
+        data = b"".join(fp.chunks())
+    assert data == b"x" * 300000
+    assert fp.digest == hashlib.sha256(data).hexdigest()
+
+
+def test_feed(tmp_path):
+    spawner = Spawner(BasicLogger(level=LogLevel.ERROR))
+    dst = [sys.executable, "-c", "import sys\nprint(len(sys.stdin.read()))"]
+    with stream(tmp_path, "print('abc')", limit=1024) as fp:
+        fp.fill()
+        job = spawner.feed(fp.chunks(), dst, source="cmd")
+    assert list(job.lines) == ["4"]
+
+
+fingerprint_toml = """
+[settings]
+tmp-dir = "{base}/build"
+cache-dir = false
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[repos.other]
+kind = "local"
+path = "{base}/other"
+repo-key-file = "{pwfile}"
+
+[profiles.pkgs]
+command = "echo same-output"
+fingerprint = true
+"""
+
+
+def test_unchanged_output_is_skipped(fake_bin, make_app):
+    def backups():
+        app = make_app(toml)
+        app.backup("pkgs")
+        return len(fake_bin.calls("restic backup"))
+
+    toml = fingerprint_toml
+    assert backups() == 1
+    assert backups() == 1
+    # same output stored into another repository or with other arguments
+    toml = fingerprint_toml + 'repo = "other"\n'
+    assert backups() == 2
+    assert backups() == 2
+    toml = fingerprint_toml + 'repo = "other"\ncli-args = ["--host", "x"]\n'
+    assert backups() == 3
+    toml = toml.replace("same-output", "new-output")
+    assert backups() == 4
+    assert (fake_bin.root / "stdin-pkgs").read_text() == "new-output\n"
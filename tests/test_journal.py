@@ -0,0 +1,174 @@
+import subprocess as procs
+import threading
+import time
+
+import pytest
+
+from lohup.history import History
+from lohup.journal import Journal
+from lohup.logger import BasicLogger, LogLevel
+
+
+backup_toml = """
+[settings]
+tmp-dir = "{base}/build"
+cache-dir = false
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[[hooks.before-all]]
+kind = "btrfs"
+action = "snapshot"
+subvolume = "{base}/data"
+snapshot = "{base}/snap"
+
+[[hooks.before-all]]
+kind = "command"
+command = "record-hook before"
+
+[[hooks.after-all]]
+kind = "btrfs"
+action = "delete"
+subvolume = "{base}/snap"
+
+[profiles.one]
+paths = ["{base}/snap/one"]
+
+[profiles.two]
+paths = ["{base}/snap/two"]
+
+[profiles.three]
+paths = ["{base}/snap/three"]
+"""
+
+
+def backed_up(fake_bin):
+    return [x.split()[3] for x in fake_bin.calls("restic backup")]
+
+
+def test_journal_roundtrip(tmp_path):
+    path = tmp_path / "journal.json"
+    journal = Journal(path)
+    journal.hook_done("before-all", 0)
+    journal.profile_done("docs", "abc")
+    loaded = Journal.load(path)
+    assert loaded.started == journal.started
+    assert loaded.is_hook_done("before-all", 0)
+    assert not loaded.is_hook_done("before-all", 1)
+    assert loaded.completed == {"docs": "abc"}
+    loaded.reset_hooks("before-all")
+    assert not Journal.load(path).is_hook_done("before-all", 0)
+    loaded.finish()
+    assert Journal.load(path) is None
+
+
+def test_concurrent_profiles(tmp_path):
+    path = tmp_path / "journal.json"
+    journal = Journal(path)
+
+    def complete(worker):
+        for i in range(100):
+            journal.profile_done(f"profile-{worker}-{i}", None)
+
+    threads = [threading.Thread(target=complete, args=(x,)) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(Journal.load(path).completed) == 400
+
+
+def test_failed_run_is_resumed(tmp_path, fake_bin, make_app):
+    app = make_app(backup_toml)
+    fake_bin.fail("two")
+    with pytest.raises(procs.CalledProcessError):
+        app.backup_all()
+    journal = Journal.load(tmp_path / "build" / "backup-all.journal.json")
+    assert list(journal.completed) == ["one"]
+    # after-all hooks removed the snapshot, so before-all ones must run again
+    assert journal.hooks == {}
+    assert not (tmp_path / "snap").exists()
+
+    fake_bin.fail("two", enabled=False)
+    fake_bin.reset()
+    app.backup_all(resume=True)
+    assert backed_up(fake_bin) == ["two", "three"]
+    assert len(fake_bin.calls("btrfs subvolume snapshot")) == 1
+    assert Journal.load(tmp_path / "build" / "backup-all.journal.json") is None
+
+
+def test_interrupted_run_reuses_snapshot(tmp_path, fake_bin, make_app):
+    app = make_app(backup_toml)
+    # state left by a run killed before its after-all hooks
+    (tmp_path / "snap").mkdir()
+    journal = Journal(tmp_path / "build" / "backup-all.journal.json")
+    journal.hooks = {"before-all": [0, 1]}
+    journal.completed = {"one": "abc"}
+    journal.save()
+
+    app.backup_all(resume=True)
+    assert backed_up(fake_bin) == ["two", "three"]
+    # btrfs snapshot still exists, the command hook is executed again
+    assert fake_bin.calls("btrfs subvolume snapshot") == []
+    assert fake_bin.calls("hook") == ["hook before"]
+    assert len(fake_bin.calls("btrfs subvolume delete")) == 1
+
+
+def test_without_resume_journal_is_ignored(tmp_path, fake_bin, make_app):
+    app = make_app(backup_toml)
+    journal = Journal(tmp_path / "build" / "backup-all.journal.json")
+    journal.completed = {"one": "abc"}
+    journal.save()
+    app.backup_all()
+    assert backed_up(fake_bin) == ["one", "two", "three"]
+
+
+class RecordingLogger(BasicLogger):
+    def __init__(self):
+        super().__init__(level=LogLevel.ERROR)
+        self.records = []
+
+    def info(self, msg):
+        self.records.append(msg)
+
+    def warning(self, msg):
+        self.records.append(msg)
+
+
+def run_while_busy(fake_bin, first, second):
+    """
+    Starts `first` in a thread, runs `second` once a backup is in progress.
+    """
+    fake_bin.slow()
+    thread = threading.Thread(target=first)
+    thread.start()
+    while not fake_bin.calls("restic backup"):
+        time.sleep(0.01)
+    try:
+        second()
+    finally:
+        thread.join()
+
+
+def test_concurrent_backup_all(tmp_path, fake_bin, make_app):
+    first, second = make_app(backup_toml), make_app(backup_toml)
+    second.log = RecordingLogger()
+    run_while_busy(fake_bin, first.backup_all, lambda: second.backup_all(resume=True))
+    # the live run's journal is neither resumed nor reported as interrupted
+    assert not [x for x in second.log.records if "was interrupted" in x]
+    assert not [x for x in second.log.records if x.startswith("Resuming")]
+    assert sorted(backed_up(fake_bin)) == ["one", "three", "two"]
+    assert Journal.load(tmp_path / "build" / "backup-all.journal.json") is None
+
+
+def test_waiting_run_keeps_history(tmp_path, fake_bin, make_app):
+    first, second = make_app(backup_toml), make_app(backup_toml)
+    run_while_busy(
+        fake_bin, lambda: first.backup("one"), lambda: second.backup("two")
+    )
+    history = History.load(tmp_path / "build" / "state" / "history.json")
+    assert sorted(history.profiles) == ["one", "two"]
@@ -0,0 +1,31 @@
+import threading
+import time
+
+from lohup.logger import BasicLogger, LogLevel
+from lohup.memory import MemoryScheduler, go_environ
+
+
+def test_go_environ():
+    assert go_environ(1000, 50) == {"GOMEMLIMIT": "900", "GOGC": "50"}
+    assert go_environ(None, None) == {}
+
+
+def test_scheduler_waits_for_memory():
+    scheduler = MemoryScheduler(capacity=100, log=BasicLogger(level=LogLevel.DEBUG))
+    events = []
+
+    def job(name, estimate):
+        with scheduler.reserve(name, estimate):
+            events.append(f"start {name}")
+            time.sleep(0.2)
+            events.append(f"stop {name}")
+
+    first = threading.Thread(target=job, args=("a", 80))
+    first.start()
+    time.sleep(0.05)
+    # doesn't fit along with "a", but runs alone afterwards
+    second = threading.Thread(target=job, args=("b", 150))
+    second.start()
+    first.join()
+    second.join()
+    assert events == ["start a", "stop a", "start b", "stop b"]
@@ -0,0 +1,70 @@
+import subprocess as procs
+import sys
+
+import pytest
+
+from lohup.logger import BasicLogger, LogLevel, RateLimiter
+from lohup.output import Spawner
+
+
+class RecordingLogger(BasicLogger):
+    def __init__(self):
+        super().__init__(level=LogLevel.DEBUG, limiter=RateLimiter(interval=60))
+        self.records = []
+
+    def error(self, msg):
+        self.records.append(("error", msg))
+
+    def output(self, source, line):
+        self.records.append((source, line))
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_progress_rate_limited():
+    log = RecordingLogger()
+    code = "for i in range(5): print(f'[0:0{i}] {i}.00%  1 files')\nprint('done')"
+    Spawner(log).check_call(python(code), source="docs")
+    assert log.records == [("docs", "[0:00] 0.00%  1 files"), ("docs", "done")]
+
+
+def test_failure_dumps_tail():
+    log = RecordingLogger()
+    code = "import sys\nfor i in range(10): print(i)\nsys.exit(3)"
+    with pytest.raises(procs.CalledProcessError):
+        Spawner(log, tail=2).check_call(python(code), source="docs")
+    assert log.records[-1] == ("error", "docs: last 2 lines of output:\n8\n9")
+
+
+def test_pipe():
+    log = RecordingLogger()
+    src = python("print('payload')")
+    dst = python("import sys\nprint(sys.stdin.read().upper())")
+    Spawner(log).pipe(src, dst, source="cmd")
+    assert log.records == [("cmd", "PAYLOAD")]
+
+
+ENGINE = "import sys\nsys.stdin.buffer.read()\nprint('saved')"
+
+
+def test_pipe_failed_source_is_not_stored():
+    log = RecordingLogger()
+    src = python("import sys\nprint('partial', flush=True)\nsys.exit(2)")
+    with pytest.raises(procs.CalledProcessError) as exc:
+        Spawner(log).pipe(src, python(ENGINE), source="cmd")
+    assert exc.value.cmd == src
+    assert ("cmd", "saved") not in log.records
+
+
+def test_feed_failed_source_is_not_stored():
+    log = RecordingLogger()
+
+    def chunks():
+        yield b"partial"
+        raise procs.CalledProcessError(2, ["producer"])
+
+    with pytest.raises(procs.CalledProcessError):
+        Spawner(log).feed(chunks(), python(ENGINE), source="cmd")
+    assert ("cmd", "saved") not in log.records
@@ -0,0 +1,125 @@
+import json
+
+from click.testing import CliRunner
+
+from lohup.app import Lohup
+from lohup.cli import cli
+from lohup.logger import BasicLogger, LogLevel
+from lohup.snapshot import Snapshot, parse_restic, parse_rustic
+
+summary = {
+    "backup_end": "2024-01-02T00:01:00+00:00",
+    "files_new": 1,
+    "files_changed": 2,
+    "total_files_processed": 4,
+    "data_added_packed": 10,
+    "data_added": 20,
+    "total_bytes_processed": 100,
+}
+restic_snap = {
+    "id": "0123456789abcdef",
+    "short_id": "01234567",
+    "time": "2024-01-02T00:00:00.123456789+00:00",
+    "tree": "ffff",
+    "paths": ["/home"],
+    "hostname": "host",
+    "uid": 1000,
+    "tags": ["documents"],
+    "summary": summary,
+}
+
+
+def test_restic():
+    (snap,) = parse_restic(json.dumps([restic_snap]))
+    assert isinstance(snap, Snapshot)
+    assert snap.short_id == "01234567"
+    assert snap.name == "documents"
+    assert snap.time.minute == 0
+    assert snap.summary.changes == 3
+    assert (snap.summary.backup_end - snap.time).seconds == 59
+    assert not hasattr(snap, "__dict__")
+
+
+def test_rustic_groups():
+    rustic_snap = dict(restic_snap, original="fedcba", summary=None)
+    del rustic_snap["short_id"]
+    group = {"hostname": "host", "label": "", "paths": ["/home"]}
+    (snap,) = parse_rustic(json.dumps([[group, [rustic_snap]]]))
+    assert snap.original == "fedcba"
+    assert snap.summary is None
+    assert snap.paths == ("/home",)
+
+
+repos_toml = """
+[settings]
+tmp-dir = "{base}/build"
+cache-dir = false
+subsystem-name = "{subsystem}"
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[repos.cloud]
+kind = "local"
+path = "{base}/cloud"
+repo-key-file = "{pwfile}"
+
+[repos.offsite]
+kind = "local"
+path = "{base}/offsite"
+repo-key-file = "{pwfile}"
+"""
+
+
+def snap(id, time):
+    return Snapshot({"id": id, "time": time})
+
+
+def write_config(tmp_path, subsystem="restic"):
+    pwfile = tmp_path / "password.txt"
+    pwfile.write_text("1")
+    path = tmp_path / "lohup.toml"
+    text = repos_toml.format(base=tmp_path, pwfile=pwfile, subsystem=subsystem)
+    path.write_text(text)
+    return path
+
+
+def test_all_repos_merged_by_time(tmp_path, stub_engines):
+    stub_engines["local"].snaps = [snap("a1", "2026-01-01T00:00:00+00:00")]
+    stub_engines["cloud"].snaps = [
+        snap("c1", "2025-12-31T00:00:00+00:00"),
+        snap("c2", "2026-01-02T00:00:00+00:00"),
+    ]
+    stub_engines["offsite"].error = RuntimeError("connection refused")
+    app = Lohup(write_config(tmp_path), logger=BasicLogger(level=LogLevel.ERROR))
+    app.load()
+    merged, failed = app.snapshots_all(is_json=True)
+    assert [(x.id, x.repo) for x in merged] == [
+        ("c1", "cloud"),
+        ("a1", "local"),
+        ("c2", "cloud"),
+    ]
+    assert failed == ["offsite"]
+
+
+def test_cli_fails_when_repo_fails(tmp_path, stub_engines):
+    stub_engines["local"].snaps = [snap("a1", "2026-01-01T00:00:00+00:00")]
+    stub_engines["offsite"].error = RuntimeError("connection refused")
+    config = str(write_config(tmp_path))
+    result = CliRunner().invoke(cli, ["--config", config, "snapshots", "--all"])
+    assert result.exit_code == 1
+    assert "Snapshot a1" in result.output
+    assert "Failed to query repos: offsite" in result.output
+    result = CliRunner().invoke(cli, ["--config", config, "snapshots"])
+    assert result.exit_code == 0
+
+
+def test_rustic_raw_latest(tmp_path, stub_engines):
+    config = str(write_config(tmp_path, subsystem="rustic"))
+    args = ["--config", config, "snapshots", "--raw", "--latest", "1"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 2
+    assert "--latest can't be used with --raw" in result.output
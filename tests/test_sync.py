@@ -0,0 +1,123 @@
+import pytest
+
+from lohup.config import LocalRepository, S3Repository
+from lohup.logger import BasicLogger, LogLevel
+from lohup.restic import Restic
+from lohup.snapshot import Snapshot
+from lohup.util import Masked
+
+
+def snap(id, tags=(), original=None):
+    time = "2026-01-01T00:00:00"
+    return Snapshot({"id": id, "time": time, "tags": list(tags), "original": original})
+
+
+sync_toml = """
+[settings]
+tmp-dir = "{base}/build"
+cache-dir = false
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[repos.cloud]
+kind = "local"
+path = "{base}/cloud"
+repo-key-file = "{pwfile}"
+"""
+
+
+def test_missing_snapshots_copied_per_tag(make_app, stub_engines):
+    app = make_app(sync_toml)
+    stub_engines["local"].snaps = [
+        snap("aaa", tags=["docs"]),
+        snap("bbb", tags=["docs"]),
+        snap("ccc", tags=["db"]),
+        snap("ddd", tags=["db"]),
+        snap("eee"),
+    ]
+    # "aaa" copied under the same ID, "ccc" as a copy with a new one
+    stub_engines["cloud"].snaps = [
+        snap("aaa", tags=["docs"]),
+        snap("fff", tags=["db"], original="ccc"),
+    ]
+    app.sync("local", "cloud")
+    assert sorted(stub_engines["cloud"].copies) == [
+        ("local", ["bbb"]),
+        ("local", ["ddd"]),
+        ("local", ["eee"]),
+    ]
+    assert stub_engines["local"].copies == []
+
+
+def test_tag_filter(make_app, stub_engines):
+    app = make_app(sync_toml)
+    stub_engines["local"].snaps = [snap("aaa", tags=["docs"]), snap("bbb", tags=["db"])]
+    app.sync("local", "cloud", tags=("db",))
+    assert stub_engines["cloud"].copies == [("local", ["bbb"])]
+
+
+def test_up_to_date(make_app, stub_engines):
+    app = make_app(sync_toml)
+    stub_engines["local"].snaps = [snap("aaa", tags=["docs"])]
+    stub_engines["cloud"].snaps = [snap("bbb", tags=["docs"], original="aaa")]
+    app.sync("local", "cloud")
+    assert stub_engines["cloud"].copies == []
+
+
+def test_same_repository(make_app, stub_engines):
+    app = make_app(sync_toml)
+    with pytest.raises(ValueError):
+        app.sync("local", "local")
+
+
+class RecordingSpawner:
+    def __init__(self):
+        self.env = None
+
+    def check_call(self, cmd, source, env=None):
+        self.env = env
+
+
+def s3_repo(tmp_path, name, key):
+    (tmp_path / f"{key}.key").write_text(key)
+    return S3Repository(
+        name,
+        endpoint="https://s3.example.com",
+        region="eu-central-1",
+        access_key_file=Masked(str(tmp_path / f"{key}.key")),
+        secret_key_file=Masked(str(tmp_path / f"{key}.key")),
+        repo_key_file=Masked(str(tmp_path / "password.txt")),
+        bucket="backups",
+        path=f"/{name}",
+        default=False,
+    )
+
+
+def test_restic_copy_credentials(tmp_path, monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_DEFAULT_REGION"):
+        monkeypatch.delenv(name, raising=False)
+    log = BasicLogger(level=LogLevel.ERROR)
+    local = LocalRepository(
+        "local",
+        path=str(tmp_path / "repo"),
+        repo_key_file=Masked(str(tmp_path / "password.txt")),
+        default=True,
+    )
+    spawner = RecordingSpawner()
+    target = Restic(local, log=log, spawner=spawner)
+    # S3 source into local target takes credentials of the source
+    target.copy_from(Restic(s3_repo(tmp_path, "cloud", "first"), log=log), ["a"], "x")
+    assert spawner.env["AWS_ACCESS_KEY_ID"] == "first"
+    assert spawner.env["AWS_DEFAULT_REGION"] == "eu-central-1"
+    # S3 repositories with the same keys share them
+    target = Restic(s3_repo(tmp_path, "mirror", "first"), log=log, spawner=spawner)
+    target.copy_from(Restic(s3_repo(tmp_path, "cloud", "first"), log=log), ["a"], "x")
+    assert spawner.env["AWS_ACCESS_KEY_ID"] == "first"
+    target = Restic(s3_repo(tmp_path, "mirror", "second"), log=log, spawner=spawner)
+    with pytest.raises(ValueError, match="one set of AWS credentials"):
+        source = Restic(s3_repo(tmp_path, "cloud", "first"), log=log)
+        target.copy_from(source, ["a"], "x")
@@ -0,0 +1,52 @@
+from lohup.history import History
+from lohup.logger import BasicLogger, LogLevel
+from lohup.output import BackupResult
+from lohup.tuning import ConnectionTuner
+
+MiB = 1024**2
+
+
+def result(added, duration):
+    return BackupResult("a", added=added, duration=duration)
+
+
+def test_hill_climbing(tmp_path):
+    history = History.load(tmp_path / "history.json")
+    tuner = ConnectionTuner(history, log=BasicLogger(level=LogLevel.DEBUG))
+    assert tuner.current("cloud") == 5
+    # too small to measure
+    tuner.record("cloud", 5, [result(MiB, 1)])
+    assert tuner.current("cloud") == 5
+    tuner.record("cloud", 5, [result(100 * MiB, 10)])
+    assert tuner.current("cloud") == 7
+    tuner.record("cloud", 7, [result(100 * MiB, 20)])
+    assert tuner.current("cloud") == 5
+    # learned value survives between runs
+    history = History.load(tmp_path / "history.json")
+    assert ConnectionTuner(history, log=tuner.log).current("cloud") == 5
+
+
+def test_run_is_one_sample(tmp_path):
+    history = History.load(tmp_path / "history.json")
+    tuner = ConnectionTuner(history, log=BasicLogger(level=LogLevel.DEBUG))
+    # profiles too small alone, measured together; skipped ones don't count
+    run = [result(40 * MiB, 4), result(40 * MiB, 4), result(0, 30)]
+    tuner.record("cloud", 5, run)
+    assert tuner.current("cloud") == 7
+    assert history.repo("cloud")["samples"] == [{"connections": 5, "rate": 10 * MiB}]
+
+
+def test_decision_uses_mean_per_count(tmp_path):
+    history = History.load(tmp_path / "history.json")
+    tuner = ConnectionTuner(history, log=BasicLogger(level=LogLevel.DEBUG))
+    tuner.record("cloud", 5, [result(100 * MiB, 10)])
+    tuner.record("cloud", 7, [result(100 * MiB, 8)])
+    assert tuner.current("cloud") == 9
+    tuner.record("cloud", 9, [result(100 * MiB, 20)])
+    assert tuner.current("cloud") == 7
+    # 7 has a slow sample now, but its mean is still faster than 9
+    tuner.record("cloud", 7, [result(100 * MiB, 12)])
+    assert tuner.current("cloud") == 5
+    # 5 (10 MiB/s) is slower than 7 (about 10.4 MiB/s on average)
+    tuner.record("cloud", 5, [result(100 * MiB, 10)])
+    assert tuner.current("cloud") == 7
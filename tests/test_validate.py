@@ -56,3 +56,24 @@ def test_hook_error(tmp_path):
         app.load()
     env.log.error(exc.value)
     assert str(exc.value.__cause__) == msg
+
+
+toml3 = """
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+replicate-to = "cloud"
+"""
+
+
+def test_replicate_to_unknown(tmp_path):
+    env = RepoEnvironment(tmp_path)
+    pwfile = env.write_password()
+    path = tmp_path / "lohup.toml"
+    path.write_text(toml3.format(base=tmp_path, pwfile=pwfile))
+    app = Lohup(config_path=path, logger=env.log)
+    msg = "repo 'local': field 'replicate-to': invalid repository 'cloud'"
+    with pytest.raises(ConfigError, match="Failed to parse TOML config") as exc:
+        app.load()
+    assert str(exc.value.__cause__) == msg
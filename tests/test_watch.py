@@ -0,0 +1,109 @@
+from dataclasses import replace
+import time
+
+import pytest
+
+from lohup.config import WatchSpec
+from lohup.logger import BasicLogger, LogLevel
+from lohup.watch import ChangeTrigger, Inotify, Watcher
+
+
+def test_trigger_coalesces_bursts():
+    spec = WatchSpec(changes=3, bytes=None, debounce=10, max_delay=100, min_interval=50)
+    trigger = ChangeTrigger(spec)
+    for now in range(3):
+        trigger.record(now)
+    # threshold reached, but changes keep coming
+    assert not trigger.due(5)
+    assert trigger.due(12)
+    trigger.reset(12)
+    trigger.record(13)
+    # below threshold, waits for max delay, then for min interval
+    assert not trigger.due(60)
+    assert trigger.due(113)
+
+
+def test_failed_backup_keeps_changes():
+    calls = []
+
+    def backup(name):
+        calls.append(name)
+        if len(calls) == 1:
+            raise RuntimeError("repository is locked")
+
+    spec = WatchSpec(changes=1, bytes=None, debounce=0, max_delay=0, min_interval=0.3)
+    log = BasicLogger(level=LogLevel.ERROR)
+    watcher = Watcher([], backup=backup, log=log, poll_interval=0.01)
+    watcher._inotify = Inotify()
+    trigger = watcher.triggers["docs"] = ChangeTrigger(spec)
+    try:
+        trigger.record(time.monotonic(), size=10)
+        watcher.step()
+        assert calls == ["docs"]
+        assert (trigger.changes, trigger.size) == (1, 10)
+        # retried once min interval passes
+        watcher.step()
+        assert calls == ["docs"]
+        time.sleep(0.35)
+        watcher.step()
+        assert calls == ["docs", "docs"]
+        assert trigger.changes == 0
+    finally:
+        watcher._inotify.close()
+
+
+watch_toml = """
+[settings]
+tmp-dir = "{base}/build"
+backup-base-dir = "{base}/snap"
+
+[repos.local]
+kind = "local"
+path = "{base}/repo"
+repo-key-file = "{pwfile}"
+default = true
+
+[[hooks.before-all]]
+kind = "btrfs"
+action = "snapshot"
+subvolume = "{base}/home"
+snapshot = "$BDIR"
+
+[profiles.code]
+paths = ["$BDIR/code"]
+exclude-paths = ["$BDIR/code/build", "node_modules"]
+watch = {{ changes = 1 }}
+
+[profiles.docs]
+paths = ["$BDIR/docs"]
+watch = {{ paths = ["{base}/live-docs"] }}
+"""
+
+
+def test_snapshot_paths_mapped_to_subvolume(tmp_path, make_app):
+    app = make_app(watch_toml)
+    code = app._watched(app.config.profiles["code"])
+    assert code.paths == [f"{tmp_path}/home/code"]
+    assert code.exclude_paths == [f"{tmp_path}/home/code/build", "node_modules"]
+    docs = app._watched(app.config.profiles["docs"])
+    assert docs.paths == [f"{tmp_path}/live-docs"]
+    # backup itself still uses the snapshot
+    assert app.config.profiles["code"].paths == [f"{tmp_path}/snap/code"]
+
+
+def test_unwatchable_paths(tmp_path, make_app):
+    app = make_app(watch_toml)
+    log = BasicLogger(level=LogLevel.ERROR)
+    code = app._watched(app.config.profiles["code"])
+    # snapshotted subvolume doesn't exist yet
+    with pytest.raises(ValueError, match="is not an existing directory"):
+        Watcher([code], backup=app.backup, log=log).run()
+    (tmp_path / "home").mkdir()
+    (tmp_path / "home" / "code").write_text("a file")
+    with pytest.raises(ValueError, match="is not an existing directory"):
+        Watcher([code], backup=app.backup, log=log).run()
+    (tmp_path / "home" / "code").unlink()
+    (tmp_path / "home" / "code" / "build").mkdir(parents=True)
+    excluded = replace(code, exclude_paths=["code"])
+    with pytest.raises(ValueError, match="no directories to watch"):
+        Watcher([excluded], backup=app.backup, log=log).run()